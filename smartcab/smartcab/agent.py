@@ -1,13 +1,18 @@
-import random
-import itertools
-from environment import Agent, Environment
-from planner import RoutePlanner
-from simulator import Simulator
+from .environment import Agent, Environment
+from .planner import RoutePlanner
+from .simulator import Simulator
+from .qtable import StateEncoder, QTable
+from .replay import ReplayBuffer
+from .convergence import ConvergenceMonitor
+from .telemetry import INFO, TRIAL
+from .profiler import profiler
 
 class LearningAgent(Agent):
     """An agent that learns to drive in the smartcab world."""
     
     sim = None
+    state_encoder = None
+    q_table = None
     q_hat = None
     policy = None
     
@@ -21,166 +26,98 @@ class LearningAgent(Agent):
     discount_rate = 0.9                 # gamma
     destination_reached_count = 0
     destination_reached_percentage = 0.0
+    penalty_count = 0                   # number of actions with a negative reward
     num_of_trials = 500
+    trial_count = 0                     # number of trials completed (carried over when resuming from a checkpoint)
+    
+    checkpoint_path = None              # directory to save the Q-table, policy and exploration state to, and warm start from
+    checkpoint_interval = 50            # save every this many trials (0: only when explicitly saved, e.g. at exit)
+    
+    learn_from_next_state = False       # learn each transition from the state sensed at the next update, instead of from the inputs sensed before acting (use with a low discount_rate, e.g. 0.2; see README)
+    replay_capacity = 0                 # no. of past transitions kept for experience replay (0: no replay; see README for a setting that helps)
+    replay_ratio = 1.0                  # replayed transitions per real transition
+    replay_batch_size = 32              # transitions per batched replay update
 
-    def __init__(self, env):
+    def __init__(self, env, **params):
         super(LearningAgent, self).__init__(env)  # sets self.env = env, state = None, next_waypoint = None, and a default color
         self.color = 'red'  # override color
+        
+        # override tuning parameters (class attributes above) for this agent, e.g. LearningAgent(env, learning_rate=0.5)
+        for name, value in params.items():
+            if not hasattr(LearningAgent, name):
+                raise TypeError("LearningAgent.__init__(): unknown parameter '{}'".format(name))
+            setattr(self, name, value)
+        
         self.planner = RoutePlanner(self.env, self)  # simple route planner to get next_waypoint
+        self.random = self.env.spawn_random()  # own random number stream (exploration, replay), seeded from the environment's
         
         # TODO: Initialize any additional variables here
         
-        direction_custom = ["Fo", "Fo/Ri", "Ri", "Ri/Ba", "Ba", "Ba/Le", "Le", "Fo/Le"]         # shortest direction to destination calculated using a custom function 
-        direction_waypoint = ["forward", "left", "right"]                                       # shortest direction to destination gotten as waypoint from planner
-        direction = direction_custom if self.useCustomDirection else direction_waypoint
-        traffic_light = ["RED", "GRN"]                                                          # traffic light at intersection
-        traffic_intersection = ["N", "O", "L", "R", "O/L", "O/R", "L/R", "O/L/R"]               # traffic situation with other cabs at intersection
-        
-        state_labels_combo = list(itertools.product(direction, traffic_light, traffic_intersection))
-        full_state_labels_combo = ["{}-{}-{}".format(a,b,c) for a, b, c in state_labels_combo]
-        full_state_labels_combo.append("GOAL")
-        self.q_hat = {x:[0, 0, 0, 0] for x in full_state_labels_combo}
-        self.policy = {x:-1 for x in full_state_labels_combo}
+        # states are encoded as small integers (direction, traffic light, traffic situation at intersection); see StateEncoder
+        self.state_encoder = StateEncoder(use_custom_direction=self.useCustomDirection)
+        if self.q_table is None:
+            self.q_table = QTable(self.state_encoder.num_states, len(Environment.valid_actions), rng=self.random)  # unless shared, e.g. LearningAgent(env, q_table=other.q_table)
+        self.q_hat = self.q_table.q_hat     # [state index, action index] -> estimated Q value
+        self.policy = self.q_table.policy   # [state index] -> action index (-1 if not learned yet)
+        self.state_index = None
+        self.steps_to_goal = []             # no. of steps taken in each trial where the destination was reached
         
         self.exploration_rate = self.max_exploration_rate
+        
+        self.replay = ReplayBuffer(self.replay_capacity) if self.replay_capacity > 0 else None
+        self.replay_credit = 0.0            # replayed transitions owed, drawn in mini-batches of replay_batch_size
+        self.last_transition = None         # (state index, action index, reward) of the last step, learned once its next state is sensed
+        
+        if self.checkpoint_path is not None and QTable.exists(self.checkpoint_path):
+            self.load_checkpoint()
 
     def reset(self, destination=None):
+        if self.state_index is not None:
+            # a trial has finished
+            self.trial_count = self.trial_count + 1
+            if self.checkpoint_path is not None and self.checkpoint_interval > 0 and self.trial_count % self.checkpoint_interval == 0:
+                self.save_checkpoint()
+        self.last_transition = None  # cut off by the deadline: the next state is never observed, so it is not learned from
         self.planner.route_to(destination)
         # TODO: Prepare for a new trip; reset any variables here, if required
 
-    def get_dir_to_destination(self, agent_state):
-        location = agent_state['location']
-        destination = agent_state['destination']
-        heading = agent_state['heading']
-        
-        # get the direction of the destination from the cab's position in the global (up, down, right, left) co-ordinates
-        col = self.env.grid_size[0]
-        row = self.env.grid_size[1]
-        loc_row = location[1]
-        dest_row = destination[1]
-        loc_col = location[0]
-        dest_col = destination[0]
-        
-        up_dist = loc_row - dest_row
-        if up_dist < 0:
-            up_dist = row + up_dist
-        down_dist = dest_row - loc_row
-        if down_dist < 0:
-            down_dist = row + down_dist
-        
-        right_dist = dest_col - loc_col
-        if right_dist < 0:
-            right_dist = col + right_dist
-        left_dist = loc_col - dest_col
-        if left_dist < 0:
-            left_dist = col + left_dist
-        
-        vertical_dist = up_dist if up_dist <= down_dist else -down_dist
-        horizontal_dist = right_dist if right_dist <= left_dist else -left_dist
-        
-        # convert cab's global (up, down, right, left) co-ordinates position to the global index co-ordinates
-        index = -1
-        if vertical_dist == 0 and horizontal_dist != 0:
-            if horizontal_dist < 0:
-                index = 6
-            else:
-                index = 2
-        elif vertical_dist != 0 and horizontal_dist == 0:
-            if vertical_dist < 0:
-                index = 4
-            else:
-                index = 0
-        elif horizontal_dist > 0:
-            if vertical_dist < 0:
-                index = 3
-            else:
-                index = 1
-        elif horizontal_dist < 0:
-            if vertical_dist < 0:
-                index = 5
-            else:
-                index = 7
-        
-        # convert the direction of the destination from the cab's position from the global co-ordinates to the cab's local co-ordinates
-        index_cab_view_local = -1
-        if heading[0] == -1 and heading[1] == 0:
-            index_cab_view_local = index - 6
-            if index_cab_view_local < 0:
-                index_cab_view_local = 8 + index_cab_view_local
-        elif heading[0] == 1 and heading[1] == 0:
-            index_cab_view_local = index - 2
-            if index_cab_view_local < 0:
-                index_cab_view_local = 8 + index_cab_view_local
-        elif heading[0] == 0 and heading[1] == 1:
-            index_cab_view_local = index - 4
-            if index_cab_view_local < 0:
-                index_cab_view_local = 8 + index_cab_view_local
-        elif heading[0] == 0 and heading[1] == -1:
-            index_cab_view_local = index - 0
-            if index_cab_view_local < 0:
-                index_cab_view_local = 8 + index_cab_view_local
+    def save_checkpoint(self, path=None):
+        # save Q-table and policy (as .npy files that can be memory-mapped back) and exploration state
+        path = path if path is not None else self.checkpoint_path
+        self.q_table.save(path)
+        QTable.save_progress(path, self.exploration_rate, self.trial_count, self.destination_reached_count, self.penalty_count)
+        self.env.telemetry.log(TRIAL, "LearningAgent.save_checkpoint(): saved to {} after {} trials", path, self.trial_count)
         
-        #print "LearningAgent.state_status(): up_dist = {}, down_dist = {}".format(up_dist, down_dist)  # [debug]
-        #print "LearningAgent.state_status(): right_dist = {}, left_dist = {}".format(right_dist, left_dist)  # [debug]
-        #print "LearningAgent.state_status(): vertical_dist = {}, horizontal_dist = {}".format(vertical_dist, horizontal_dist)  # [debug]
-        #print "LearningAgent.state_status(): index = {}, index_cab_view_local = {}".format(index, index_cab_view_local)  # [debug]
+    def load_checkpoint(self, path=None, mmap_mode='c'):
+        # warm start from a checkpoint: Q-table and policy are memory-mapped (copy-on-write by default, see QTable.load)
+        path = path if path is not None else self.checkpoint_path
+        q_table = QTable.load(path, mmap_mode=mmap_mode)
+        q_table.rng = self.q_table.rng
+        if q_table.q_hat.shape != self.q_table.q_hat.shape:
+            raise ValueError("LearningAgent.load_checkpoint(): Q-table in {} has shape {}, expected {}".format(path, q_table.q_hat.shape, self.q_table.q_hat.shape))
+        self.q_table = q_table
+        self.q_hat = q_table.q_hat
+        self.policy = q_table.policy
         
-        #print "LearningAgent.state_status(): state_labels_combo = {}".format(state_labels_combo)  # [debug]
-        #print "LearningAgent.state_status(): full_state_labels_combo = {}".format(full_state_labels_combo)  # [debug]
-        #print "LearningAgent.state_status(): full_q_hat = {}".format(full_q_hat['Ri/Ba-RED-O'][0])  # [debug]
-        #print "LearningAgent.state_status(): traffic_intersection = {}".format(traffic_intersection)  # [debug]
+        progress = QTable.load_progress(path)
+        if progress is not None:
+            self.exploration_rate = progress["exploration_rate"]
+            self.trial_count = progress["trial_count"]
+            self.destination_reached_count = progress["destination_reached_count"]
+            self.penalty_count = progress["penalty_count"]
+        self.env.telemetry.log(INFO, "LearningAgent.load_checkpoint(): resuming from {} after {} trials", path, self.trial_count)
         
-        dir_to_destination = ""
+    def get_dir_to_destination(self, agent_state):
+        # direction of the destination from the cab's position (shortest way round the wrap-around grid), in the cab's local co-ordinates,
+        # e.g. "Fo/Ri" (Forward and Right) or "Ba" (Back Only); "" at the destination
+        return self.planner.routes.direction_to(agent_state.location, agent_state.heading, agent_state.destination)
         
-        if index_cab_view_local == 0:
-            dir_to_destination = "Fo"              # Forward Only
-        elif index_cab_view_local == 1:
-            dir_to_destination = "Fo/Ri"           # Forward and Right
-        elif index_cab_view_local == 2:
-            dir_to_destination = "Ri"              # Right Only
-        elif index_cab_view_local == 3:
-            dir_to_destination = "Ri/Ba"           # Right and Back
-        elif index_cab_view_local == 4:
-            dir_to_destination = "Ba"              # Back Only
-        elif index_cab_view_local == 5:
-            dir_to_destination = "Ba/Le"           # Back and Left
-        elif index_cab_view_local == 6:
-            dir_to_destination = "Le"              # Left Only
-        elif index_cab_view_local == 7:
-            dir_to_destination = "Fo/Le"           # Forward and Left
-                
-        return dir_to_destination
+    def get_state_index(self, inputs, agent_state):
+        direction = self.get_dir_to_destination(agent_state) if self.useCustomDirection else self.planner.next_waypoint()
+        return self.state_encoder.encode(direction, inputs)
         
     def get_state_status(self, inputs, agent_state):
-        state_label = self.get_dir_to_destination(agent_state) if self.useCustomDirection else self.planner.next_waypoint()
-        state_label = None if (state_label == "" or state_label == None) else state_label
-        
-        if state_label == None:
-            state_label = "GOAL"
-        else:
-            if inputs['light'] == 'red':
-                state_label = state_label + "-RED"
-            elif inputs['light'] == 'green':
-                state_label = state_label + "-GRN"
-
-            if inputs['oncoming'] == None and inputs['left'] == None and inputs['right'] == None: 
-                state_label = state_label + "-N"
-            elif inputs['oncoming'] != None and inputs['left'] == None and inputs['right'] == None: 
-                state_label = state_label + "-O"
-            elif inputs['oncoming'] == None and inputs['left'] != None and inputs['right'] == None: 
-                state_label = state_label + "-L"
-            elif inputs['oncoming'] == None and inputs['left'] == None and inputs['right'] != None: 
-                state_label = state_label + "-R"
-            elif inputs['oncoming'] != None and inputs['left'] != None and inputs['right'] == None: 
-                state_label = state_label + "-O/L"
-            elif inputs['oncoming'] != None and inputs['left'] == None and inputs['right'] != None: 
-                state_label = state_label + "-O/R"
-            elif inputs['oncoming'] == None and inputs['left'] != None and inputs['right'] != None: 
-                state_label = state_label + "-L/R"
-            elif inputs['oncoming'] != None and inputs['left'] != None and inputs['right'] != None: 
-                state_label = state_label + "-O/L/R"
-        
-        return state_label
+        return self.state_encoder.labels[self.get_state_index(inputs, agent_state)]
 
     def get_action_index(self, action):
         index = -1
@@ -211,7 +148,26 @@ class LearningAgent(Agent):
         return label
     
     
+    def learn(self, state_index, action_index, reward, next_state_index):
+        # TODO: Learn policy based on state, action, reward
+        # update the estimate Q value for the current state and action based on the values of the next state and maximum Q value of possible actions,
+        # then update policy with action with max estimated Q value in this particular state
+        self.q_table.update(state_index, action_index, reward, next_state_index, self.learning_rate, self.discount_rate)
+
+        # experience replay: keep the transition, and learn again from mini-batches of past ones
+        if self.replay is not None:
+            self.replay.add(state_index, action_index, reward, next_state_index)
+            if len(self.replay) >= self.replay_batch_size:
+                self.replay_credit = self.replay_credit + self.replay_ratio
+            while self.replay_credit >= self.replay_batch_size:
+                self.q_table.batch_update(*self.replay.sample(self.replay_batch_size, self.random.random_state), learning_rate=self.learning_rate, discount_rate=self.discount_rate)
+                self.replay_credit = self.replay_credit - self.replay_batch_size
+
     def update(self, t):
+        profiling = profiler.enabled
+        if profiling:
+            phase_start = profiler.clock()
+        
         # Gather inputs
         self.next_waypoint = self.planner.next_waypoint()  # from route planner, also displayed by simulator
         inputs = self.env.sense(self)
@@ -222,76 +178,89 @@ class LearningAgent(Agent):
         
         if use_random_actions:
             # observe our current state
-            state_label = self.get_state_status(inputs=inputs, agent_state=self.env.agent_states[self])
-            self.state = state_label
+            self.state_index = self.get_state_index(inputs=inputs, agent_state=self.env.agent_states[self])
+            self.state = self.state_encoder.labels[self.state_index]
             
             # select a random action
-            action = random.choice([None, 'forward', 'left', 'right'])
+            action = self.random.choice([None, 'forward', 'left', 'right'])
             
             # determine reward for performing action in the current state
             reward = self.env.act(self, action)
             
-            #print "LearningAgent.update(): deadline = {}, inputs = {}, action = {}, reward = {}".format(deadline, inputs, action, reward)  # [debug]
+            #print("LearningAgent.update(): deadline = {}, inputs = {}, action = {}, reward = {}".format(deadline, inputs, action, reward))  # [debug]
             
             
             #if inputs['oncoming'] != None or inputs['left'] != None or inputs['right'] != None:
                 #self.sim.paused = True
                 #self.sim.pause()   
         else:
-            # observe our current state
-            state_label = self.get_state_status(inputs=inputs, agent_state=self.env.agent_states[self])
-            self.state = state_label
+            if profiling:
+                phase_start = profiler.add('LearningAgent.update.sense', phase_start)
             
+            # observe our current state
+            state_index = self.get_state_index(inputs=inputs, agent_state=self.env.agent_states[self])
+            self.state_index = state_index
+            self.state = self.state_encoder.labels[state_index]
+
+            # the previous step's transition led here: learn from it now that its next state is observed
+            if self.last_transition is not None:
+                self.learn(*self.last_transition, next_state_index=state_index)
+                self.last_transition = None
+                if profiling:
+                    phase_start = profiler.add('LearningAgent.update.learn', phase_start)
+
             # select action from policy
-            action_index = self.policy[self.state]
+            action_index = int(self.policy[state_index])
             
             # add random restarts [with a probability of 1-epsilon] to solve local optima issues similar to algorithm in simulated annealing
             self.exploration_rate = self.exploration_rate - (self.exploration_rate * self.decay_exploration_rate)
             self.exploration_rate = self.exploration_rate if self.exploration_rate > self.min_exploration_rate else self.min_exploration_rate
-            if (random.random() > (1-self.exploration_rate)) or (action_index < 0):  
+            if (self.random.random() > (1-self.exploration_rate)) or (action_index < 0):  
                 action_index_list = [0, 1, 2, 3]
                 if action_index >= 0:
                     action_index_list.remove(action_index)
                     
-                action_index = random.choice(action_index_list)
+                action_index = self.random.choice(action_index_list)
                 #action_index = random.choice([1, 2, 3]) # favor action over in-action
                 
                 #if action_index < 0:
-                #    print "LearningAgent.random(): using random policy for state action pair not yet set. actionList = {}".format(action_index_list)  # [debug]
+                #    print("LearningAgent.random(): using random policy for state action pair not yet set. actionList = {}".format(action_index_list))  # [debug]
                 #else:
-                #    print "LearningAgent.random(): using random, random number greater than (1-exploration_rate). actionList = {}".format(action_index_list)  # [debug]
+                #    print("LearningAgent.random(): using random, random number greater than (1-exploration_rate). actionList = {}".format(action_index_list))  # [debug]
                     
                 #self.sim.paused = True
                 #self.sim.pause()
                 
             action = self.get_action_label(action_index)
+            if profiling:
+                phase_start = profiler.add('LearningAgent.update.state', phase_start)
         
             # determine reward for performing action in the current state
             reward = self.env.act(self, action)
+            if reward < 0:
+                self.penalty_count = self.penalty_count + 1
+            if profiling:
+                phase_start = profiler.add('LearningAgent.update.act', phase_start)
             
-            # observe the next state that we will transition into based on the current state and action
-            next_state_label = self.get_state_status(inputs=inputs, agent_state=self.env.agent_states[self])
-            
-            # select the maximum estimated Q value from the new state and all the possible actions
-            max_q_hat = -1000000.
-            for i in range(len(self.q_hat[self.state])):
-                if self.q_hat[next_state_label][i] > max_q_hat:
-                    max_q_hat = self.q_hat[next_state_label][i]
-                    
-            # update the estimate Q value for the current state and action based on the values of the next state and maximum Q value of possible actions
-            new_q_hat = reward + (self.discount_rate * max_q_hat)
-            self.q_hat[self.state][action_index] = ((1-self.learning_rate) * self.q_hat[self.state][action_index]) + (self.learning_rate * new_q_hat)
-            
-            # TODO: Learn policy based on state, action, reward
-            # update policy with action with max estimated Q value in this particular state
-            max_q_hat = -1000000.
-            for i in range(len(self.q_hat[self.state])):
-                if self.q_hat[self.state][i] > max_q_hat:
-                    max_q_hat = self.q_hat[self.state][i]
-                    self.policy[self.state] = i
-                elif self.q_hat[self.state][i] == max_q_hat:
-                    self.policy[self.state] = random.choice([i, self.policy[self.state]])
-                    
+            agent_state = self.env.agent_states[self]
+            if not self.learn_from_next_state:
+                # observe the next state that we will transition into based on the current state and action
+                next_state_index = self.get_state_index(inputs=inputs, agent_state=agent_state)
+                self.learn(state_index, action_index, reward, next_state_index)
+                if profiling:
+                    profiler.add('LearningAgent.update.learn', phase_start)
+            elif agent_state.location == agent_state.destination:
+                # the trip ends in the GOAL state
+                next_state_index = self.state_encoder.goal
+                self.learn(state_index, action_index, reward, next_state_index)
+                if profiling:
+                    profiler.add('LearningAgent.update.learn', phase_start)
+            else:
+                # the next state is what we sense at our next update (after lights and other cars have moved;
+                # sensing right after acting would miss that, e.g. a red light turning green)
+                next_state_index = None
+                self.last_transition = (state_index, action_index, reward)
+
                     
             printDebug = {
                 "update": False,
@@ -306,40 +275,46 @@ class LearningAgent(Agent):
             printDebug["exploration"] = self.sim.debug_e if hasattr(self.sim, 'debug_e') else False
             
             if printDebug["update"]:
-                #print "LearningAgent.update(): deadline = {}, inputs = {}, action = {}, reward = {}".format(deadline, inputs, action, reward)  # [debug]
-                print "LearningAgent.update(): deadline = {}, action = {}, reward = {}".format(deadline, action, reward)  # [debug]
-                print "LearningAgent.update(): inputs = {}, next_waypoint = {}".format(inputs, self.next_waypoint)  # [debug]
+                #print("LearningAgent.update(): deadline = {}, inputs = {}, action = {}, reward = {}".format(deadline, inputs, action, reward))  # [debug]
+                print("LearningAgent.update(): deadline = {}, action = {}, reward = {}".format(deadline, action, reward))  # [debug]
+                print("LearningAgent.update(): inputs = {}, next_waypoint = {}".format(inputs, self.next_waypoint))  # [debug]
             
             if printDebug["state"]:
-                print "LearningAgent.current_state(): state_label = {}".format(state_label)  # [debug]
-                for i in range(len(self.q_hat[self.state])):
-                    print "LearningAgent.policy(): q_hat[self.state][{}] = {}".format(i, self.q_hat[self.state][i])  # [debug]
+                print("LearningAgent.current_state(): state_label = {}".format(self.state))  # [debug]
+                for i in range(len(self.q_hat[state_index])):
+                    print("LearningAgent.policy(): q_hat[self.state][{}] = {}".format(i, self.q_hat[state_index][i]))  # [debug]
                     
-                print "LearningAgent.next_state(): next_state_label = {}".format(next_state_label)  # [debug]
-                for i in range(len(self.q_hat[next_state_label])):
-                    print "LearningAgent.policy(): q_hat[next_state_label][{}] = {}".format(i, self.q_hat[next_state_label][i])  # [debug]
+                if next_state_index is not None:
+                    print("LearningAgent.next_state(): next_state_label = {}".format(self.state_encoder.labels[next_state_index]))  # [debug]
+                    for i in range(len(self.q_hat[next_state_index])):
+                        print("LearningAgent.policy(): q_hat[next_state_label][{}] = {}".format(i, self.q_hat[next_state_index][i]))  # [debug]
                 
             if printDebug["policy"]:
-                for key, val in self.policy.iteritems():
-                    print "LearningAgent.policy(): policy[{}] = {}".format(key, val)  # [debug]
+                for i, val in enumerate(self.policy):
+                    print("LearningAgent.policy(): policy[{}] = {}".format(self.state_encoder.labels[i], val))  # [debug]
                     
             if printDebug["exploration"]:
                 for i in range(len(self.policy)):
-                    print "LearningAgent.exploration(): exploration_rate = {}".format(self.exploration_rate)  # [debug]
+                    print("LearningAgent.exploration(): exploration_rate = {}".format(self.exploration_rate))  # [debug]
         
         # count number of times cab reached its destination
         # pause sim if cab reaches its destination
-        location = self.env.agent_states[self]['location']
-        destination = self.env.agent_states[self]['destination']
+        location = self.env.agent_states[self].location
+        destination = self.env.agent_states[self].destination
         if destination[0] == location[0] and destination[1] == location[1]:
             self.destination_reached_count = self.destination_reached_count + 1
+            self.steps_to_goal.append(t + 1)
             self.destination_reached_percentage = self.destination_reached_count * 1.0 / self.num_of_trials
             #self.sim.paused = True
             #self.sim.pause()
             
-            print "LearningAgent.goal_count(): destination_reached_count = {}".format(self.destination_reached_count)  # [debug]
-            print "LearningAgent.goal_percentage(): destination_reached_count = {}".format(self.destination_reached_percentage)  # [debug]
+            self.env.telemetry.log(TRIAL, "LearningAgent.goal_count(): destination_reached_count = {}", self.destination_reached_count)  # [debug]
+            self.env.telemetry.log(TRIAL, "LearningAgent.goal_percentage(): destination_reached_count = {}", self.destination_reached_percentage)  # [debug]
             
+        # record this step, if the environment's telemetry recorder has a path
+        if self.env.telemetry.recording:
+            trip = self.env.trips[self]
+            self.env.telemetry.record_step(trip['index'], self.env.trial, t, self.state_index, Environment.valid_actions.index(action), reward, deadline, trip['success'])
         
         #self.sim.paused = True
         #self.sim.pause()
@@ -350,19 +325,33 @@ def run():
 
     # Set up environment and agent
     e = Environment()  # create environment (also adds some dummy traffic)
+    # NOTE: For a reproducible run, seed the environment, e.g. Environment(seed=0); agents' random streams are derived from it
+    # NOTE: To record per-step/per-trial telemetry and cut console output, set e.telemetry = TelemetryRecorder(path, level=INFO)
+    # NOTE: For heavy background traffic, Environment(num_dummies=1000, traffic_field=True) moves all dummy cars in one vectorized pass per step
     a = e.create_agent(LearningAgent)  # create agent
     e.set_primary_agent(a, enforce_deadline=True)  # specify agent to track
     # NOTE: You can set enforce_deadline=False while debugging to allow longer trials
+    # NOTE: To learn from several cabs at once, add more that share the Q-table, each with a trip of its own:
+    #   e.add_primary_agent(e.create_agent(LearningAgent, q_table=a.q_table))
 
     # Now simulate it
     sim = Simulator(e, update_delay=0.01, display=True)  # create simulator (uses pygame when display=True, if available)
     # NOTE: To speed up simulation, reduce update_delay and/or set display=False
+    # NOTE: For batch training, use Simulator(e, fast_forward=True) to step headless as fast as possible
+    # NOTE: To watch a long run live at full simulation speed, use e.g. Simulator(e, render_fps=30) or render_every=100 (steps)
     
     a.sim = sim
 
-    sim.run(n_trials=a.num_of_trials)  # run for a specified number of trials
+    monitor = ConvergenceMonitor(a.q_table)  # tracks Q value and policy changes and the rolling success rate
+    sim.run(n_trials=a.num_of_trials - a.trial_count, on_trial_end=monitor)  # run for a specified number of trials (the remaining ones, if resumed from a checkpoint), or until converged
+    # NOTE: To always run all trials, leave out on_trial_end; monitor.curve() has per-trial progress, monitor.save_curve(path) writes it as CSV
     # NOTE: To quit midway, press Esc or close pygame window, or hit Ctrl+C on the command-line
+    # NOTE: To save progress periodically and at exit, and resume from it, create the agent with checkpoint_path="some/directory"
     
+    if a.checkpoint_path is not None:
+        if a.state_index is not None:
+            a.trial_count = a.trial_count + 1  # the last trial (completed or interrupted) is not followed by a reset
+        a.save_checkpoint()
 
 
 if __name__ == '__main__':
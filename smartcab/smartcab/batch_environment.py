@@ -0,0 +1,217 @@
+import numpy as np
+
+from .environment import Environment, TrafficLight
+from .planner import RouteTable
+
+# Actions, waypoints and sensed inputs are encoded as indices into Environment.valid_actions
+NONE, FORWARD, LEFT, RIGHT = [Environment.valid_actions.index(a) for a in (None, 'forward', 'left', 'right')]
+
+# Headings are encoded as indices into Environment.valid_headings (ENWS), so that a left turn is +1 and a right turn is -1 (mod 4)
+heading_dx = np.array([h[0] for h in Environment.valid_headings], dtype=np.int32)
+heading_dy = np.array([h[1] for h in Environment.valid_headings], dtype=np.int32)
+
+
+class BatchEnvironment(object):
+    """Many independent smartcab worlds, stepped in lockstep with NumPy array operations.
+
+    Each world mirrors Environment: a wrap-around grid with a traffic light at every intersection,
+    num_dummies dummy cabs and one primary cab that is driven by the actions passed to step().
+    Within a world, agents are processed in the same order as in Environment (dummies first, then
+    the primary cab), so Environment.sense/act rules are reproduced exactly; only the loop over
+    worlds is vectorized.
+
+    Locations are 0-based, i.e. (x - bounds[0], y - bounds[1]) in Environment coordinates.
+    """
+
+    hard_time_limit = Environment.hard_time_limit
+
+    def __init__(self, num_worlds, grid_size=(8, 6), num_dummies=3, light_periods=None, enforce_deadline=True, auto_reset=True, seed=None):
+        self.num_worlds = num_worlds
+        self.grid_size = grid_size  # (cols, rows)
+        self.num_dummies = num_dummies
+        self.num_agents = num_dummies + 1
+        self.primary = num_dummies  # primary cab is created last, as in agent.run()
+        self.enforce_deadline = enforce_deadline
+        self.auto_reset = auto_reset  # start a new trial in a world as soon as its current one ends
+        self.random = np.random.RandomState(seed)
+        self._worlds = np.arange(num_worlds)
+        self.routes = RouteTable.get(grid_size)
+
+        n, a = num_worlds, self.num_agents
+        cols, rows = grid_size
+
+        # Traffic lights (see TrafficLightGrid): state = phase (True = NS open, False = EW open), flipped every period ticks since reset
+        self.light_phase = self.random.randint(0, 2, (n, cols, rows)).astype(bool)
+        light_periods = light_periods if light_periods is not None else TrafficLight.valid_periods
+        self.light_period = self.random.choice(light_periods, (n, cols, rows)).astype(np.int32)
+        self.light_t = np.zeros(n, dtype=np.int32)  # time of the last light update in each world
+
+        # Agents
+        self.loc_x = self.random.randint(0, cols, (n, a)).astype(np.int32)
+        self.loc_y = self.random.randint(0, rows, (n, a)).astype(np.int32)
+        self.heading = np.full((n, a), Environment.valid_headings.index((0, 1)), dtype=np.int32)
+        self.waypoint = np.full((n, a), NONE, dtype=np.int32)  # dummies: next move; primary: last route planner output
+        self.waypoint[:, :num_dummies] = self.random.randint(FORWARD, RIGHT + 1, (n, num_dummies))
+
+        # Primary cab trip
+        self.destination_x = np.zeros(n, dtype=np.int32)
+        self.destination_y = np.zeros(n, dtype=np.int32)
+        self.deadline = np.zeros(n, dtype=np.int32)
+
+        self.t = np.zeros(n, dtype=np.int32)
+        self.done = np.zeros(n, dtype=bool)
+        self.success = np.zeros(n, dtype=bool)  # worlds whose trial ended at the destination on the last step
+        self.trials = np.zeros(n, dtype=np.int64)  # completed trials per world
+        self.successes = np.zeros(n, dtype=np.int64)
+        self.inputs = None  # primary cab inputs for the current tick, as returned by Environment.sense
+
+    def reset(self, mask=None):
+        """Start a new trial in the selected worlds (all by default) and advance them to the primary cab's first decision."""
+        mask = np.ones(self.num_worlds, dtype=bool) if mask is None else mask
+        self._reset(mask)
+        self._begin_tick(mask)
+
+    def _reset(self, mask):
+        idx = np.flatnonzero(mask)
+        k = len(idx)
+        cols, rows = self.grid_size
+
+        self.t[idx] = 0
+        self.done[idx] = False
+        self.light_phase[idx] ^= (self.light_t[idx, None, None] // self.light_period[idx]) % 2 == 1  # lights keep their state
+        self.light_t[idx] = 0
+
+        # Pick a start and a destination, not too close to each other
+        start_x = self.random.randint(0, cols, k)
+        start_y = self.random.randint(0, rows, k)
+        dest_x = self.random.randint(0, cols, k)
+        dest_y = self.random.randint(0, rows, k)
+        close = (np.abs(dest_x - start_x) + np.abs(dest_y - start_y)) < 4
+        while close.any():
+            m = close.sum()
+            start_x[close] = self.random.randint(0, cols, m)
+            start_y[close] = self.random.randint(0, rows, m)
+            dest_x[close] = self.random.randint(0, cols, m)
+            dest_y[close] = self.random.randint(0, rows, m)
+            close = (np.abs(dest_x - start_x) + np.abs(dest_y - start_y)) < 4
+
+        p = self.primary
+        self.loc_x[idx, p] = start_x
+        self.loc_y[idx, p] = start_y
+        self.heading[idx, p] = self.random.randint(0, 4, k)
+        self.destination_x[idx] = dest_x
+        self.destination_y[idx] = dest_y
+        self.deadline[idx] = (np.abs(dest_x - start_x) + np.abs(dest_y - start_y)) * 5
+
+        # Scatter dummies
+        d = self.num_dummies
+        self.loc_x[idx, :d] = self.random.randint(0, cols, (k, d))
+        self.loc_y[idx, :d] = self.random.randint(0, rows, (k, d))
+        self.heading[idx, :d] = self.random.randint(0, 4, (k, d))
+
+    def step(self, actions):
+        """Apply the primary cabs' actions, finish the current tick and advance to the next decision.
+
+        Returns (rewards, done): per-world rewards, and which worlds finished a trial on this step.
+        Worlds that are already done (and not auto-reset) ignore their action and get a zero reward.
+        """
+        actions = np.asarray(actions)
+        active = ~self.done
+        green, oncoming = self.inputs['light'], self.inputs['oncoming']
+        p = self.primary
+
+        # Move primary cabs that obey traffic rules
+        okay = np.where(actions == FORWARD, green,
+                        np.where(actions == LEFT, green & ((oncoming == NONE) | (oncoming == LEFT)), True))
+        rewards = np.where(okay, np.where(actions == NONE, 0.0, np.where(actions == self.waypoint[:, p], 2.0, -0.5)), -1.0)
+        self._move(p, active & okay & (actions != NONE), actions)
+
+        reached = active & (self.loc_x[:, p] == self.destination_x) & (self.loc_y[:, p] == self.destination_y)
+        rewards += np.where(reached & (self.deadline >= 0), 10.0, 0.0)
+        rewards[~active] = 0.0
+
+        # Finish the tick
+        self.t[active] += 1
+        expired = (self.deadline <= self.hard_time_limit) | (self.enforce_deadline & (self.deadline <= 0))
+        finished = active & (reached | expired)
+        self.deadline[active] -= 1
+        self.done |= finished
+        self.success = reached
+        self.trials += finished
+        self.successes += reached
+
+        if self.auto_reset:
+            self._reset(finished)
+            self._begin_tick(active)
+        else:
+            self._begin_tick(active & ~finished)
+        return rewards, finished
+
+    def _begin_tick(self, mask):
+        """Update lights and dummies in the selected worlds, then sense for the primary cabs."""
+        # Update traffic lights
+        self.light_t[mask] = self.t[mask]
+
+        # Update dummies, one at a time (later dummies see earlier dummies' moves)
+        for i in range(self.num_dummies):
+            green, oncoming, left, right = self._sense(i)
+            waypoint = self.waypoint[:, i]
+            okay = np.where(waypoint == RIGHT, green | (left != FORWARD),
+                            np.where(waypoint == FORWARD, green,
+                                     green & (oncoming != FORWARD) & (oncoming != RIGHT)))
+            move = mask & okay
+            self._move(i, move, waypoint)
+            self.waypoint[move, i] = self.random.randint(FORWARD, RIGHT + 1, move.sum())
+
+        # Primary cab: next waypoint from the route planner, then sense
+        p = self.primary
+        self.waypoint[:, p] = np.where(mask, self.next_waypoints(), self.waypoint[:, p])
+        green, oncoming, left, right = self._sense(p)
+        self.inputs = {'light': green, 'oncoming': oncoming, 'left': left, 'right': right}
+
+    def _sense(self, i):
+        """Vectorized Environment.sense for agent i in every world; light is a boolean (green) array."""
+        x, y, h = self.loc_x[:, i], self.loc_y[:, i], self.heading[:, i]
+        green = self.light_states(x, y) == (h % 2 == 1)  # odd headings are NS
+        oncoming = np.full(self.num_worlds, NONE, dtype=np.int32)
+        left = np.full(self.num_worlds, NONE, dtype=np.int32)
+        right = np.full(self.num_worlds, NONE, dtype=np.int32)
+        for j in range(self.num_agents):
+            if j == i:
+                continue
+            other_heading = self.heading[:, j]
+            present = (self.loc_x[:, j] == x) & (self.loc_y[:, j] == y) & (other_heading != h)
+            if not present.any():
+                continue
+            waypoint = self.waypoint[:, j]
+            relative = (other_heading - h) % 4
+            m = present & (relative == 2) & (oncoming != LEFT)  # we don't want to override oncoming == 'left'
+            oncoming[m] = waypoint[m]
+            m = present & (relative == 1) & (right != FORWARD) & (right != LEFT)  # we don't want to override right == 'forward' or 'left'
+            right[m] = waypoint[m]
+            m = present & (relative == 3) & (left != FORWARD)  # we don't want to override left == 'forward'
+            left[m] = waypoint[m]
+        return green, oncoming, left, right
+
+    def light_states(self, x, y):
+        """Light state at intersection (x[w], y[w]) of each world w."""
+        return self.light_phase[self._worlds, x, y] ^ ((self.light_t // self.light_period[self._worlds, x, y]) % 2 == 1)
+
+    def _move(self, i, mask, actions):
+        """Turn and advance agent i (with wrap-around) in the worlds selected by mask."""
+        h = self.heading[:, i]
+        h = np.where(mask, np.where(actions == LEFT, (h + 1) % 4, np.where(actions == RIGHT, (h + 3) % 4, h)), h)
+        self.heading[:, i] = h
+        self.loc_x[:, i] = np.where(mask, (self.loc_x[:, i] + heading_dx[h]) % self.grid_size[0], self.loc_x[:, i])
+        self.loc_y[:, i] = np.where(mask, (self.loc_y[:, i] + heading_dy[h]) % self.grid_size[1], self.loc_y[:, i])
+
+    def route_index(self):
+        """RouteTable index of the primary cab in every world."""
+        p = self.primary
+        return (self.heading[:, p],
+                (self.destination_x - self.loc_x[:, p]) % self.grid_size[0],
+                (self.destination_y - self.loc_y[:, p]) % self.grid_size[1])
+
+    def next_waypoints(self):
+        """Vectorized RoutePlanner.next_waypoint for the primary cab in every world."""
+        return self.routes.next_hop[self.route_index()].astype(np.int32)
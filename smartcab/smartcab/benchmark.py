@@ -0,0 +1,214 @@
+import sys
+import os
+import json
+import tempfile
+import platform
+import argparse
+import resource
+import multiprocessing
+
+import numpy as np
+
+from .environment import Agent, AgentState, Environment
+from .planner import RoutePlanner
+from .simulator import Simulator
+from .agent import LearningAgent
+from .batch_environment import BatchEnvironment
+from .scenario import generate, ScenarioFile
+from .telemetry import QUIET
+from .profiler import Profiler
+
+clock = Profiler.clock
+
+
+def quiet_environment(*args, **kwargs):
+    env = Environment(*args, **kwargs)
+    env.telemetry.level = QUIET
+    return env
+
+
+def bench_env_step(grid_size, num_dummies, steps, seed, traffic_field=False):
+    env = quiet_environment(grid_size=grid_size, num_dummies=num_dummies, seed=seed, traffic_field=traffic_field)
+    env.reset()
+    start = clock()
+    for i in range(steps):
+        env.step()
+    return steps, clock() - start, 'steps/sec'
+
+
+def bench_env_sense(grid_size, num_dummies, rounds, seed):
+    env = quiet_environment(grid_size=grid_size, num_dummies=num_dummies, seed=seed)
+    env.reset()
+    agents = list(env.agent_states)
+    start = clock()
+    for i in range(rounds):
+        env.sense_cache.clear()  # measure uncached senses
+        for agent in agents:
+            env.sense(agent)
+    return rounds * len(agents), clock() - start, 'senses/sec'
+
+
+def bench_env_reset(grid_size, num_dummies, resets, seed):
+    env = quiet_environment(grid_size=grid_size, num_dummies=num_dummies, seed=seed)
+    start = clock()
+    for i in range(resets):
+        env.reset()
+    return resets, clock() - start, 'resets/sec'
+
+
+def bench_env_reset_scenarios(grid_size, num_dummies, resets, seed):
+    # resets replaying a scenario file instead of drawing trial setups at random
+    env = quiet_environment(grid_size=grid_size, num_dummies=num_dummies, seed=seed)
+    handle, path = tempfile.mkstemp(suffix='.npy')
+    os.close(handle)
+    try:
+        generate(path, resets, grid_size, num_dummies, num_primary=0, seed=seed)
+        env.use_scenarios(ScenarioFile(path))
+        start = clock()
+        for i in range(resets):
+            env.reset()
+        return resets, clock() - start, 'resets/sec'
+    finally:
+        os.remove(path)
+
+
+def bench_env_snapshot(grid_size, num_dummies, rounds, seed):
+    # snapshot, a short look-ahead, restore: as a rollout-based controller would per candidate action
+    env = quiet_environment(grid_size=grid_size, num_dummies=num_dummies, seed=seed)
+    env.reset()
+    snapshot = env.snapshot()
+    start = clock()
+    for i in range(rounds):
+        env.snapshot(out=snapshot)
+        env.step()
+        env.restore(snapshot)
+    return rounds, clock() - start, 'rounds/sec'
+
+
+def bench_planner(grid_size, calls, seed):
+    env = quiet_environment(grid_size=grid_size, num_dummies=0, seed=seed)
+    agent = env.create_agent(Agent)
+    planner = RoutePlanner(env, agent)
+    planner.route_to(env.intersections.random_intersection())
+    states = [AgentState(env.intersections.random_intersection(), env.random.choice(env.valid_headings)) for i in range(1000)]
+    start = clock()
+    for i in range(calls):
+        env.agent_states[agent] = states[i % 1000]
+        planner.next_waypoint()
+    return calls, clock() - start, 'calls/sec'
+
+
+def bench_training(trials, seed):
+    env = quiet_environment(seed=seed)
+    agent = env.create_agent(LearningAgent)
+    env.set_primary_agent(agent, enforce_deadline=True)
+    sim = Simulator(env, display=False, fast_forward=True)
+    agent.sim = sim
+    stats = sim.run(n_trials=trials)
+    return stats['steps'], stats['elapsed'], 'steps/sec'
+
+
+def bench_batch_step(num_worlds, steps, seed):
+    batch = BatchEnvironment(num_worlds, seed=seed)
+    batch.reset()
+    start = clock()
+    for i in range(steps):
+        batch.step(batch.next_waypoints())
+    return num_worlds * steps, clock() - start, 'world-steps/sec'
+
+
+# name -> (function, kwargs)
+benchmarks = [
+    ('env_step[8x6,dummies=3]', bench_env_step, dict(grid_size=(8, 6), num_dummies=3, steps=20000)),
+    ('env_step[8x6,dummies=100]', bench_env_step, dict(grid_size=(8, 6), num_dummies=100, steps=1000)),
+    ('env_step[100x100,dummies=1000]', bench_env_step, dict(grid_size=(100, 100), num_dummies=1000, steps=200)),
+    ('env_step[1000x1000,dummies=10000]', bench_env_step, dict(grid_size=(1000, 1000), num_dummies=10000, steps=20)),
+    ('env_step[8x6,dummies=100,field]', bench_env_step, dict(grid_size=(8, 6), num_dummies=100, steps=5000, traffic_field=True)),
+    ('env_step[100x100,dummies=1000,field]', bench_env_step, dict(grid_size=(100, 100), num_dummies=1000, steps=2000, traffic_field=True)),
+    ('env_step[1000x1000,dummies=10000,field]', bench_env_step, dict(grid_size=(1000, 1000), num_dummies=10000, steps=500, traffic_field=True)),
+    ('env_sense[4x4,dummies=200]', bench_env_sense, dict(grid_size=(4, 4), num_dummies=200, rounds=100)),
+    ('env_reset[8x6,dummies=3]', bench_env_reset, dict(grid_size=(8, 6), num_dummies=3, resets=5000)),
+    ('env_reset[100x100,dummies=1000]', bench_env_reset, dict(grid_size=(100, 100), num_dummies=1000, resets=50)),
+    ('env_reset[8x6,dummies=3,scenarios]', bench_env_reset_scenarios, dict(grid_size=(8, 6), num_dummies=3, resets=5000)),
+    ('env_reset[100x100,dummies=1000,scenarios]', bench_env_reset_scenarios, dict(grid_size=(100, 100), num_dummies=1000, resets=50)),
+    ('env_snapshot[8x6,dummies=3]', bench_env_snapshot, dict(grid_size=(8, 6), num_dummies=3, rounds=5000)),
+    ('env_snapshot[100x100,dummies=1000]', bench_env_snapshot, dict(grid_size=(100, 100), num_dummies=1000, rounds=100)),
+    ('planner_next_waypoint[8x6]', bench_planner, dict(grid_size=(8, 6), calls=50000)),
+    ('training[LearningAgent,200 trials]', bench_training, dict(trials=200)),
+    ('batch_step[1000 worlds]', bench_batch_step, dict(num_worlds=1000, steps=200)),
+]
+
+
+def run_benchmark(name, function, kwargs, repeat, seed):
+    """Run one benchmark repeat times with a fixed seed; best rate and peak memory of this process."""
+    best = None
+    for i in range(repeat):
+        count, elapsed, unit = function(seed=seed, **kwargs)
+        rate = count / max(elapsed, 1e-9)
+        best = rate if best is None else max(best, rate)
+    return {'rate': best, 'unit': unit, 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run_all(pattern=None, repeat=3, seed=0):
+    """Run benchmarks (optionally only those whose name contains pattern), each in a fresh worker process."""
+    results = {}
+    for name, function, kwargs in benchmarks:
+        if pattern is not None and pattern not in name:
+            continue
+        pool = multiprocessing.Pool(1)
+        try:
+            results[name] = pool.apply(run_benchmark, (name, function, kwargs, repeat, seed))
+        finally:
+            pool.close()
+            pool.join()
+        print("{:<40} {:>14.1f} {:<16} {:>10} KB peak".format(name, results[name]['rate'], results[name]['unit'], results[name]['peak_rss_kb']))
+        sys.stdout.flush()
+    return {
+        'meta': {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+                 'numpy': np.__version__, 'machine': platform.machine(), 'repeat': repeat, 'seed': seed},
+        'results': results}
+
+
+def compare(current, baseline, threshold):
+    """Print rate and memory changes against a baseline; returns names of benchmarks that regressed beyond threshold."""
+    regressions = []
+    print("{:<40} {:>14} {:>14} {:>9} {:>9}".format('benchmark', 'baseline', 'current', 'speed', 'memory'))
+    for name, result in sorted(current['results'].items()):
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]
+        speed = result['rate'] / base['rate']
+        memory = result['peak_rss_kb'] * 1.0 / base['peak_rss_kb']
+        regressed = speed < 1 - threshold or memory > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        print("{:<40} {:>14.1f} {:>14.1f} {:>8.2f}x {:>8.2f}x{}".format(name, base['rate'], result['rate'], speed, memory, "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the smartcab engine with fixed seeds; optionally compare against a baseline.")
+    parser.add_argument('--output', default=None, help="write results as JSON to this file (e.g. a new baseline)")
+    parser.add_argument('--compare', default=None, metavar='BASELINE', help="compare results against this JSON baseline")
+    parser.add_argument('--threshold', type=float, default=0.1, help="relative slowdown or memory growth flagged as a regression (default: 0.1)")
+    parser.add_argument('--filter', default=None, metavar='PATTERN', help="only run benchmarks whose name contains PATTERN")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark; the best rate is kept (default: 3)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default: 0)")
+    args = parser.parse_args()
+
+    current = run_all(args.filter, args.repeat, args.seed)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print("{} regression(s) beyond {:.0%}: {}".format(len(regressions), args.threshold, ", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+import os
+import sys
+import argparse
+import tempfile
+
+import numpy as np
+
+from .environment import Agent, Environment, DummyAgent
+from .batch_environment import BatchEnvironment
+from .planner import RoutePlanner
+from .scenario import generate, ScenarioFile
+from .telemetry import QUIET
+
+
+class CheckedEnvironment(Environment):
+    """Environment that compares every sense() result (cached or not) with brute_force_sense(), as agents call it."""
+
+    def __init__(self, *args, **kwargs):
+        self.senses = 0
+        self.mismatches = []
+        super(CheckedEnvironment, self).__init__(*args, **kwargs)
+        self.telemetry.level = QUIET
+
+    def sense(self, agent):
+        inputs = super(CheckedEnvironment, self).sense(agent)
+        expected = brute_force_sense(self, agent)
+        self.senses += 1
+        if inputs != expected:
+            self.mismatches.append("t = {}, agent at {} heading {}: sensed {}, expected {}".format(
+                self.t, self.agent_states[agent].location, self.agent_states[agent].heading, inputs, expected))
+        return inputs
+
+
+def brute_force_sense(env, agent):
+    # sense() as it was before the occupancy index and sense cache: scan all traffic field cars, then all (unparked)
+    # agents, in creation order; light from the light array
+    state = env.agent_states[agent]
+    location = state.location
+    heading = state.heading
+    light_state = env.intersections.states[location[0] - env.bounds[0], location[1] - env.bounds[1]]
+    light = 'green' if (light_state and heading[1] != 0) or ((not light_state) and heading[0] != 0) else 'red'
+
+    others = []  # (location, heading, next waypoint)
+    if env.traffic is not None:
+        field = env.traffic
+        for i in range(len(field)):
+            others.append(((int(field.x[i]) + field.x0, int(field.y[i]) + field.y0), env.valid_headings[field.heading[i]], env.valid_actions[field.waypoint[i]]))
+    for other_agent, other_state in env.agent_states.items():
+        if agent != other_agent and other_agent not in env.parked:
+            others.append((other_state.location, other_state.heading, other_agent.get_next_waypoint()))
+
+    oncoming = None
+    left = None
+    right = None
+    for other_location, other, other_heading in others:
+        if location != other_location or heading == other:
+            continue
+        if (heading[0] * other[0] + heading[1] * other[1]) == -1:
+            if oncoming != 'left':
+                oncoming = other_heading
+        elif (heading[1] == other[0] and -heading[0] == other[1]):
+            if right != 'forward' and right != 'left':
+                right = other_heading
+        else:
+            if left != 'forward':
+                left = other_heading
+    return {'light': light, 'oncoming': oncoming, 'left': left, 'right': right}
+
+
+def check_sense(grid_size, num_dummies, trials, steps, seed, traffic_field=False):
+    # every sense() of dummies and a primary dummy on a crowded grid against a brute-force scan: as they step, and of
+    # all agents after each step (mostly cache hits, stale unless others moving in and out invalidated them)
+    env = CheckedEnvironment(grid_size=grid_size, num_dummies=num_dummies, seed=seed, traffic_field=traffic_field)
+    env.set_primary_agent(env.create_agent(DummyAgent))
+    for i in range(trials):
+        env.reset()
+        for t in range(steps):
+            env.step()
+            for agent in env.agent_states:
+                if agent not in env.parked:
+                    env.sense(agent)
+    return env.senses, env.mismatches
+
+
+class RouteFollower(Agent):
+    """Primary agent that drives along its planner's route, so its moves depend on the environment's state alone."""
+
+    def __init__(self, env):
+        super(RouteFollower, self).__init__(env)
+        self.planner = RoutePlanner(env, self)
+
+    def reset(self, destination=None):
+        self.planner.route_to(destination)
+
+    def update(self, t):
+        self.next_waypoint = self.planner.next_waypoint()
+        self.env.act(self, self.next_waypoint)
+
+
+def trajectory(env, steps):
+    # what can be observed of the environment after each of up to steps steps (fewer if the trial ends)
+    observed = []
+    for i in range(steps):
+        if env.done:
+            break
+        env.step()
+        observed.append((env.t, env.done, env.intersections.states.tobytes(), env.random.getstate(),
+                         [(state.location, state.heading, state.deadline, agent.get_next_waypoint()) for agent, state in env.agent_states.items()],
+                         [(trip['reward'], trip['penalties'], trip['success'], trip['finished']) for trip in env.trips.values()],
+                         [(field.x.tobytes(), field.y.tobytes(), field.heading.tobytes(), field.waypoint.tobytes()) for field in [env.traffic] if field is not None]))
+    return observed
+
+
+def check_snapshot(grid_size, num_dummies, trials, horizon, seed, traffic_field=False):
+    # at every step of each trial: snapshot, step up to horizon steps, restore and step again; both runs must match
+    env = CheckedEnvironment(grid_size=grid_size, num_dummies=num_dummies, seed=seed, traffic_field=traffic_field)
+    env.set_primary_agent(env.create_agent(RouteFollower), enforce_deadline=True)
+    compared = 0
+    mismatches = []
+    for i in range(trials):
+        env.reset()
+        while not env.done:
+            snapshot = env.snapshot()
+            first = trajectory(env, horizon)
+            env.restore(snapshot)
+            second = trajectory(env, horizon)
+            env.restore(snapshot)
+            compared += len(first)
+            if first != second:
+                step = next((k for k, (a, b) in enumerate(zip(first, second)) if a != b), min(len(first), len(second)))
+                mismatches.append("trial {}, t = {}: run from restored snapshot differs at step {}".format(i, env.t, step + 1))
+            env.step()
+    return compared, mismatches + env.mismatches
+
+
+def check_cars_at(grid_size, num_cars, steps, seed):
+    # traffic field cars_at() at every intersection after each step, against a scan of all cars
+    env = CheckedEnvironment(grid_size=grid_size, num_dummies=num_cars, seed=seed, traffic_field=True)
+    env.set_primary_agent(env.create_agent(RouteFollower))
+    field = env.traffic
+    compared = 0
+    mismatches = []
+    env.reset()
+    for t in range(steps):
+        if env.done:
+            env.reset()
+        env.step()
+        locations = list(zip((field.x + field.x0).tolist(), (field.y + field.y0).tolist()))
+        for location in env.intersections:
+            expected = [i for i in range(len(field)) if locations[i] == location]
+            found = field.cars_at(location)
+            compared += 1
+            if found != expected:
+                mismatches.append("t = {}, at {}: cars_at() = {}, expected {}".format(env.t, location, found, expected))
+    return compared, mismatches
+
+
+def check_scenarios(grid_size, num_dummies, count, seed, traffic_field=False):
+    # each reset() replaying a scenario file (decoded a chunk at a time) against its record, read field by field
+    handle, path = tempfile.mkstemp(suffix='.npy')
+    os.close(handle)
+    try:
+        generate(path, count, grid_size, num_dummies, seed=seed)
+        records = np.load(path)
+        env = CheckedEnvironment(grid_size=grid_size, num_dummies=num_dummies, seed=seed, traffic_field=traffic_field)
+        env.set_primary_agent(env.create_agent(RouteFollower))
+        env.use_scenarios(ScenarioFile(path))
+        field = env.traffic
+        num_cars = len(field) if field is not None else 0
+        mismatches = []
+        for i, record in enumerate(records):
+            env.reset()
+            expected = ([(tuple(record['start'][0].tolist()), Environment.valid_headings[record['heading'][0]], tuple(record['destination'][0].tolist()))] +
+                        [(tuple(location), Environment.valid_headings[heading], Environment.valid_actions[waypoint]) for location, heading, waypoint in
+                         zip(record['dummy_location'].tolist(), record['dummy_heading'].tolist(), record['dummy_waypoint'].tolist())],
+                        np.unpackbits(record['lights'])[:len(env.intersections)].tolist(), record['periods'].ravel().tolist())
+            found = ([(env.agent_states[env.primary_agent].location, env.agent_states[env.primary_agent].heading, env.agent_states[env.primary_agent].destination)] +
+                     ([((int(field.x[j]) + field.x0, int(field.y[j]) + field.y0), Environment.valid_headings[field.heading[j]], Environment.valid_actions[field.waypoint[j]])
+                       for j in range(num_cars)] if field is not None else []) +
+                     [(state.location, state.heading, agent.get_next_waypoint()) for agent, state in env.agent_states.items() if agent is not env.primary_agent],
+                     env.intersections.states.ravel().astype(int).tolist(), env.intersections.periods.ravel().tolist())
+            if found != expected:
+                mismatches.append("scenario {}: set up {}, expected {}".format(i, found, expected))
+        return len(records), mismatches
+    finally:
+        os.remove(path)
+
+
+class RandomDriver(RouteFollower):
+    """Primary agent that takes its planner's waypoint or, half the time, a random action; keeps what it sensed and got."""
+
+    def __init__(self, env, random_state):
+        super(RandomDriver, self).__init__(env)
+        self.random_state = random_state
+        self.inputs = None
+        self.action = None
+        self.reward = None
+
+    def update(self, t):
+        self.next_waypoint = self.planner.next_waypoint()
+        self.inputs = self.env.sense(self)
+        if self.random_state.random_sample() < 0.5:
+            self.action = self.next_waypoint
+        else:
+            self.action = self.env.valid_actions[self.random_state.randint(len(self.env.valid_actions))]
+        self.reward = self.env.act(self, self.action)
+
+
+class WaypointFeed(object):
+    """Stands in for a BatchEnvironment's random: hands out given dummy waypoints in turn instead of drawing them."""
+
+    def __init__(self, waypoints):
+        self.waypoints = list(waypoints)
+
+    def randint(self, low, high, size):
+        taken, self.waypoints = self.waypoints[:size], self.waypoints[size:]
+        return np.array(taken + [low] * (size - len(taken)), dtype=np.int32)
+
+
+def check_batch(grid_size, num_dummies, trials, seed):
+    # at every step of each trial: copy the Environment's state into a one-world BatchEnvironment, step both with the
+    # same action and the same new dummy waypoints, and compare what the primary cab sensed and got, and where
+    # everyone went
+    env = CheckedEnvironment(grid_size=grid_size, num_dummies=num_dummies, seed=seed)
+    primary = env.create_agent(RandomDriver, np.random.RandomState(seed))  # created last, as the batch's primary cab
+    env.set_primary_agent(primary, enforce_deadline=True)
+    batch = BatchEnvironment(1, grid_size=grid_size, num_dummies=num_dummies, enforce_deadline=True, auto_reset=False, seed=seed)
+    agents = list(env.agent_states)
+    dummies = agents[:num_dummies]
+    actions, headings = Environment.valid_actions, Environment.valid_headings
+    x0, y0 = env.bounds[0], env.bounds[1]
+    p = batch.primary
+    compared = 0
+    mismatches = []
+    for i in range(trials):
+        env.reset()
+        while not env.done:
+            batch.t[0] = env.t
+            batch.done[0] = False
+            batch.light_phase[0] = env.intersections.phases
+            batch.light_period[0] = env.intersections.periods
+            for j, agent in enumerate(agents):
+                state = env.agent_states[agent]
+                batch.loc_x[0, j], batch.loc_y[0, j] = state.location[0] - x0, state.location[1] - y0
+                batch.heading[0, j] = headings.index(state.heading)
+                batch.waypoint[0, j] = actions.index(agent.get_next_waypoint())
+            state = env.agent_states[primary]
+            batch.destination_x[0], batch.destination_y[0] = state.destination[0] - x0, state.destination[1] - y0
+            batch.deadline[0] = state.deadline
+            before = [env.agent_states[agent].location for agent in dummies]
+
+            t = env.t
+            env.step()
+            trip = env.trips[primary]
+            moved = [agent for agent, location in zip(dummies, before) if env.agent_states[agent].location != location]
+            expected = [primary.inputs, primary.next_waypoint, [(env.agent_states[agent].location, env.agent_states[agent].heading) for agent in dummies],
+                        float(primary.reward), (state.location, state.heading), state.deadline, trip['finished'], trip['success']]
+
+            batch.random = WaypointFeed(actions.index(agent.get_next_waypoint()) for agent in moved)
+            batch._begin_tick(np.ones(1, dtype=bool))
+            inputs = {'light': 'green' if batch.inputs['light'][0] else 'red',
+                      'oncoming': actions[batch.inputs['oncoming'][0]], 'left': actions[batch.inputs['left'][0]], 'right': actions[batch.inputs['right'][0]]}
+            found = [inputs, actions[batch.waypoint[0, p]],
+                     [((int(batch.loc_x[0, j]) + x0, int(batch.loc_y[0, j]) + y0), headings[batch.heading[0, j]]) for j in range(num_dummies)]]
+            rewards, finished = batch.step(np.array([actions.index(primary.action)]))
+            found += [float(rewards[0]), ((int(batch.loc_x[0, p]) + x0, int(batch.loc_y[0, p]) + y0), headings[batch.heading[0, p]]),
+                      int(batch.deadline[0]), bool(finished[0]), bool(batch.success[0])]
+            compared += 1
+            if found != expected:
+                mismatches.append("trial {}, t = {}: batch {}, expected {}".format(i, t, found, expected))
+    return compared, mismatches + env.mismatches
+
+
+# name -> (function, kwargs)
+checks = [
+    ('sense[4x4,dummies=30]', check_sense, dict(grid_size=(4, 4), num_dummies=30, trials=20, steps=50)),
+    ('sense[8x6,dummies=3]', check_sense, dict(grid_size=(8, 6), num_dummies=3, trials=50, steps=50)),
+    ('sense[4x4,dummies=30,field]', check_sense, dict(grid_size=(4, 4), num_dummies=30, trials=100, steps=50, traffic_field=True)),
+    ('snapshot[8x6,dummies=3]', check_snapshot, dict(grid_size=(8, 6), num_dummies=3, trials=20, horizon=5)),
+    ('snapshot[4x4,dummies=30]', check_snapshot, dict(grid_size=(4, 4), num_dummies=30, trials=40, horizon=5)),
+    ('snapshot[4x4,dummies=30,field]', check_snapshot, dict(grid_size=(4, 4), num_dummies=30, trials=40, horizon=5, traffic_field=True)),
+    ('cars_at[8x6,dummies=100,field]', check_cars_at, dict(grid_size=(8, 6), num_cars=100, steps=500)),
+    ('cars_at[20x20,dummies=50,field]', check_cars_at, dict(grid_size=(20, 20), num_cars=50, steps=200)),
+    ('batch[8x6,dummies=3]', check_batch, dict(grid_size=(8, 6), num_dummies=3, trials=100)),
+    ('batch[4x4,dummies=20]', check_batch, dict(grid_size=(4, 4), num_dummies=20, trials=100)),
+    ('scenarios[8x6,dummies=3]', check_scenarios, dict(grid_size=(8, 6), num_dummies=3, count=3000)),
+    ('scenarios[4x4,dummies=30,field]', check_scenarios, dict(grid_size=(4, 4), num_dummies=30, count=3000, traffic_field=True)),
+]
+
+
+def run_all(pattern=None, seed=0):
+    """Run checks (optionally only those whose name contains pattern); returns names of those that failed."""
+    failed = []
+    for name, function, kwargs in checks:
+        if pattern is not None and pattern not in name:
+            continue
+        count, mismatches = function(seed=seed, **kwargs)
+        print("{:<40} {:>10} compared  {}".format(name, count, "{} MISMATCHES".format(len(mismatches)) if mismatches else "ok"))
+        for mismatch in mismatches[:5]:
+            print("    " + mismatch)
+        sys.stdout.flush()
+        if mismatches:
+            failed.append(name)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the smartcab engine's fast paths against brute-force versions, with fixed seeds.")
+    parser.add_argument('--filter', default=None, metavar='PATTERN', help="only run checks whose name contains PATTERN")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default: 0)")
+    args = parser.parse_args()
+
+    failed = run_all(args.filter, args.seed)
+    if failed:
+        print("{} check(s) failed: {}".format(len(failed), ", ".join(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
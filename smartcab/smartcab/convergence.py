@@ -0,0 +1,87 @@
+from collections import deque
+
+import numpy as np
+
+
+class ConvergenceMonitor(object):
+    """Tracks learning progress trial by trial, and decides when training has converged.
+
+    After each trial it records the largest change of any Q value, the no. of states whose policy changed,
+    its success (the fraction of its trips, one per primary agent, that reached their destination) and the success
+    rate over the last window trials.
+    Training has converged when, over the last window trials, the success rate is at least min_success_rate,
+    at most max_policy_changes policy changes happened and no Q value moved by more than max_q_delta; a criterion
+    set to None is not checked.
+
+    Pass as Simulator.run(n_trials, on_trial_end=monitor) to stop training once converged:
+        monitor = ConvergenceMonitor(agent.q_table)
+        sim.run(n_trials=500, on_trial_end=monitor)
+        monitor.curve()  # per-trial progress
+    """
+
+    def __init__(self, q_table, window=50, min_success_rate=0.95, max_policy_changes=5, max_q_delta=None, min_trials=None):
+        self.q_table = q_table
+        self.window = window
+        self.min_success_rate = min_success_rate
+        self.max_policy_changes = max_policy_changes
+        self.max_q_delta = max_q_delta
+        self.min_trials = min_trials if min_trials is not None else window
+        self.last_q_hat = np.array(q_table.q_hat)
+        self.last_policy = np.array(q_table.policy)
+
+        # per-trial progress
+        self.q_deltas = []
+        self.policy_changes = []
+        self.successes = []
+        self.success_rates = []
+        self.converged_at = None  # no. of trials after which training converged
+        self.recent = deque(maxlen=window)  # (q delta, policy changes, success) of the last window trials
+
+    def __call__(self, env):
+        """Record the trial that just ended in env; True once converged."""
+        trips = env.trips
+        return self.update(sum(trip['success'] for trip in trips.values()) * 1.0 / len(trips) if trips else 0.0)
+
+    def update(self, success):
+        q_hat, policy = self.q_table.q_hat, self.q_table.policy
+        q_delta = float(np.abs(q_hat - self.last_q_hat).max())
+        policy_changes = int((policy != self.last_policy).sum())
+        self.last_q_hat[:] = q_hat
+        self.last_policy[:] = policy
+
+        self.recent.append((q_delta, policy_changes, success))
+        success_rate = sum(s for d, c, s in self.recent) * 1.0 / len(self.recent)
+        self.q_deltas.append(q_delta)
+        self.policy_changes.append(policy_changes)
+        self.successes.append(success)
+        self.success_rates.append(success_rate)
+
+        if self.converged_at is None and self.converged():
+            self.converged_at = len(self.successes)
+        return self.converged_at is not None
+
+    def converged(self):
+        if len(self.successes) < self.min_trials:
+            return False
+        if self.min_success_rate is not None and self.success_rates[-1] < self.min_success_rate:
+            return False
+        if self.max_policy_changes is not None and sum(c for d, c, s in self.recent) > self.max_policy_changes:
+            return False
+        if self.max_q_delta is not None and max(d for d, c, s in self.recent) > self.max_q_delta:
+            return False
+        return True
+
+    def curve(self):
+        """Per-trial progress as arrays: trial, q_delta, policy_changes, success, success_rate."""
+        return {
+            'trial': np.arange(len(self.successes)),
+            'q_delta': np.array(self.q_deltas),
+            'policy_changes': np.array(self.policy_changes, dtype=np.int32),
+            'success': np.array(self.successes, dtype=np.float64),
+            'success_rate': np.array(self.success_rates)}
+
+    def save_curve(self, path):
+        """Write the curve as CSV."""
+        curve = self.curve()
+        columns = ['trial', 'q_delta', 'policy_changes', 'success', 'success_rate']
+        np.savetxt(path, np.column_stack([curve[c] for c in columns]), fmt=['%d', '%.6g', '%d', '%.4g', '%.4f'], delimiter=',', header=','.join(columns), comments='')
@@ -1,26 +1,190 @@
 import time
+import array
 import random
 from collections import OrderedDict
 
-from simulator import Simulator
+import numpy as np
+
+from .simulator import Simulator
+from .telemetry import TelemetryRecorder, TRIAL
+from .profiler import profiler
+from .rng import BlockRandom
+from .traffic import TrafficField, sense_others
 
 class TrafficLight(object):
-    """A traffic light that switches periodically."""
+    """Traffic light states and periods; the lights themselves are kept by TrafficLightGrid."""
 
     valid_states = [True, False]  # True = NS open, False = EW open
+    valid_periods = [3, 4, 5]
+
+
+class TrafficLightView(object):
+    """Handle on one light of a TrafficLightGrid, with the state, period and last_updated a light object had."""
+
+    __slots__ = ('grid', 'index')
+
+    def __init__(self, grid, index):
+        self.grid = grid
+        self.index = index
+
+    @property
+    def state(self):
+        return self.grid.state_at(self.index)
+
+    @property
+    def period(self):
+        return int(self.grid.periods[self.index])
+
+    @property
+    def last_updated(self):
+        return self.grid.t - self.grid.t % self.period
+
+
+class AgentState(object):
+    """Where an agent is and where it is going, updated in place; also readable as the dict it used to be."""
+
+    __slots__ = ('location', 'heading', 'destination', 'deadline')
+
+    def __init__(self, location, heading, destination=None, deadline=None):
+        self.location = location
+        self.heading = heading
+        self.destination = destination
+        self.deadline = deadline
+
+    def set(self, location, heading, destination=None, deadline=None):
+        self.location = location
+        self.heading = heading
+        self.destination = destination
+        self.deadline = deadline
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
 
-    def __init__(self, state=None, period=None):
-        self.state = state if state is not None else random.choice(self.valid_states)
-        self.period = period if period is not None else random.choice([3, 4, 5])
-        self.last_updated = 0
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return [getattr(self, key) for key in self.__slots__]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+    def __repr__(self):
+        return "AgentState(location={}, heading={}, destination={}, deadline={})".format(self.location, self.heading, self.destination, self.deadline)
+
+
+class TrafficLightGrid(object):
+    """Traffic lights at every intersection of a grid, in arrays indexed by (x - x0, y - y0)."""
+
+    def __init__(self, bounds, periods=None, rng=random):
+        self.bounds = bounds
+        self.shape = (bounds[2] - bounds[0] + 1, bounds[3] - bounds[1] + 1)
+        self.random = rng  # a random.Random, for lights' phases and periods and random_intersection()
+        periods = periods if periods is not None else TrafficLight.valid_periods
+        random_state = np.random.RandomState(rng.getrandbits(32))
+        self.phases = random_state.randint(0, 2, self.shape).astype(bool)  # state at t = 0: True = NS open, False = EW open
+        self.periods = random_state.choice(periods, self.shape).astype(np.int32)
+        self.t = 0  # time of the last update; a light flips at t = period, 2 * period, ... so its state follows from t, period and phase
+        self._flipped = [False] * (max(periods) + 1)  # period -> whether lights with that period are flipped at t
+
+    def state(self, location):
+        """Light state at an intersection: True = NS open, False = EW open."""
+        return self.state_at((location[0] - self.bounds[0], location[1] - self.bounds[1]))
+
+    def state_at(self, index):
+        return bool(self.phases[index]) != self._flipped[self.periods[index]]
+
+    @property
+    def states(self):
+        """Array of all light states."""
+        return self.phases ^ ((self.t // self.periods) % 2 == 1)
 
     def reset(self):
-        self.last_updated = 0
+        # lights keep their current state, and start counting their period again from t = 0
+        self.phases = self.states
+        self.update(0)
+
+    def set_states(self, states, periods=None):
+        # like reset(), but with the given light states (and periods; see fit_periods()), arrays of the grid's shape
+        self.phases[:] = states
+        if periods is not None:
+            self.periods[:] = periods
+        self.update(0)
+
+    def fit_periods(self, longest):
+        # make room for periods up to longest in update()
+        if longest >= len(self._flipped):
+            self._flipped = [False] * (longest + 1)
+            self.update(self.t)
 
     def update(self, t):
-        if t - self.last_updated >= self.period:
-            self.state = not self.state  # assuming state is boolean
-            self.last_updated = t
+        self.t = t
+        self._flipped = [(t // period) % 2 == 1 if period > 0 else False for period in range(len(self._flipped))]
+
+    def random_intersection(self):
+        return (self.random.randint(self.bounds[0], self.bounds[2]), self.random.randint(self.bounds[1], self.bounds[3]))
+
+    # read-only mapping from intersection (x, y) to a view of its light, as the {intersection: light} dict it replaced
+
+    def __len__(self):
+        return self.shape[0] * self.shape[1]
+
+    def __contains__(self, location):
+        return self.bounds[0] <= location[0] <= self.bounds[2] and self.bounds[1] <= location[1] <= self.bounds[3]
+
+    def __iter__(self):
+        for x in range(self.bounds[0], self.bounds[2] + 1):
+            for y in range(self.bounds[1], self.bounds[3] + 1):
+                yield (x, y)
+
+    def keys(self):
+        return list(self)
+
+    def __getitem__(self, location):
+        if location not in self:
+            raise KeyError(location)
+        return TrafficLightView(self, (location[0] - self.bounds[0], location[1] - self.bounds[1]))
+
+    def values(self):
+        return [self[location] for location in self]
+
+    def items(self):
+        return [(location, self[location]) for location in self]
+
+
+class RoadNetwork(object):
+    """Roads between neighboring intersections of a grid, generated on iteration instead of stored."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+
+    def __len__(self):
+        cols, rows = self.bounds[2] - self.bounds[0] + 1, self.bounds[3] - self.bounds[1] + 1
+        return (cols - 1) * rows + cols * (rows - 1)
+
+    def __iter__(self):
+        for x in range(self.bounds[0], self.bounds[2] + 1):
+            for y in range(self.bounds[1], self.bounds[3] + 1):
+                if x < self.bounds[2]:
+                    yield ((x, y), (x + 1, y))
+                if y < self.bounds[3]:
+                    yield ((x, y), (x, y + 1))
 
 
 class Environment(object):
@@ -30,139 +194,464 @@ class Environment(object):
     valid_inputs = {'light': TrafficLight.valid_states, 'oncoming': valid_actions, 'left': valid_actions, 'right': valid_actions}
     valid_headings = [(1, 0), (0, -1), (-1, 0), (0, 1)]  # ENWS
     hard_time_limit = -100  # even if enforce_deadline is False, end trial when deadline reaches this value (to avoid deadlocks)
+    no_deadline = np.iinfo(np.int32).min  # stands for deadline None in snapshots
+    scenario_chunk_size = 1024  # scenarios read and decoded at a time (see use_scenarios)
+    _heading_index = {heading: i for i, heading in enumerate(valid_headings)}
+    _action_index = {action: i for i, action in enumerate(valid_actions)}
+
+    def __init__(self, grid_size=(8, 6), num_dummies=3, light_periods=None, seed=None, traffic_field=False):
+        # Random number streams, all derived from seed (unpredictable if None)
+        self.seed = seed
+        self.random = random.Random(seed)  # lights, agent placement, trial setup (starts, destinations, headings)
+        self.traffic_random = BlockRandom(np.random.RandomState(self.random.getrandbits(32)))  # dummy agents' moves
 
-    def __init__(self):
         self.done = False
         self.t = 0
         self.agent_states = OrderedDict()
         self.status_text = ""
+        self.telemetry = TelemetryRecorder()  # console output level and (optional) per-step/per-trial records
+        self.trial = -1  # no. of the current trial
+        self.trips = OrderedDict()  # primary agent -> its trip in this trial: index in primary_agents, net reward, penalties, success, finished
+        self.parked = set()  # primary agents that finished their trip; out of the way (not updated or sensed) until reset
+
+        # Intersection -> agents index (in creation order), and sense() results memoized within a tick
+        self.occupancy = {}
+        self.occupancy_version = {}  # bumped whenever an agent enters or leaves an intersection
+        self.sense_cache = {}
+        self._agent_order = {}
+        self._snapshot_dtype = None  # ((no. of agents, no. of trips), dtype), see snapshot_dtype()
 
         # Road network
-        self.grid_size = (8, 6)  # (cols, rows)
+        self.grid_size = tuple(grid_size)  # (cols, rows)
         self.bounds = (1, 1, self.grid_size[0], self.grid_size[1])
         self.block_size = 100
-        self.intersections = OrderedDict()
-        self.roads = []
-        for x in xrange(self.bounds[0], self.bounds[2] + 1):
-            for y in xrange(self.bounds[1], self.bounds[3] + 1):
-                self.intersections[(x, y)] = TrafficLight()  # a traffic light at each intersection
-
-        for a in self.intersections:
-            for b in self.intersections:
-                if a == b:
-                    continue
-                if (abs(a[0] - b[0]) + abs(a[1] - b[1])) == 1:  # L1 distance = 1
-                    self.roads.append((a, b))
-
-        # Dummy agents
-        self.num_dummies = 3  # no. of dummy agents
-        for i in xrange(self.num_dummies):
-            self.create_agent(DummyAgent)
-
-        # Primary agent
-        self.primary_agent = None  # to be set explicitly
+        self.intersections = TrafficLightGrid(self.bounds, light_periods, self.random)  # a traffic light at each intersection
+        self.roads = RoadNetwork(self.bounds)  # roads between neighboring intersections
+        self._cells = list(self.intersections)  # intersection index (x - 1) * rows + (y - 1) -> (x, y), for scenarios
+
+        # Dummy agents, or with traffic_field, as many dummy cars moved together (see TrafficField)
+        self.num_dummies = num_dummies  # no. of dummy agents
+        self.traffic = TrafficField(self, num_dummies) if traffic_field else None
+        if self.traffic is None:
+            for i in range(self.num_dummies):
+                self.create_agent(DummyAgent)
+
+        # Trial setups to replay, instead of drawing them at random (see use_scenarios), decoded a chunk at a time
+        self.scenarios = None
+        self._scenario_chunk = None
+        self._scenario_position = 0
+
+        # Primary agent(s)
+        self.primary_agent = None  # to be set explicitly; the first of primary_agents, whose status is displayed
+        self.primary_agents = []  # agents with a trip (start, destination, deadline) in each trial
         self.enforce_deadline = False
 
     def create_agent(self, agent_class, *args, **kwargs):
         agent = agent_class(self, *args, **kwargs)
-        self.agent_states[agent] = {'location': random.choice(self.intersections.keys()), 'heading': (0, 1)}
+        self._agent_order[agent] = len(self._agent_order)
+        state = AgentState(self.intersections.random_intersection(), (0, 1))
+        self.agent_states[agent] = state
+        self._enter(agent, state.location)
         return agent
 
+    def spawn_random(self):
+        """A new random number stream (BlockRandom) for an agent, seeded from this environment's."""
+        return BlockRandom(np.random.RandomState(self.random.getrandbits(32)))
+
     def set_primary_agent(self, agent, enforce_deadline=False):
         self.primary_agent = agent
+        self.primary_agents = [agent]
         self.enforce_deadline = enforce_deadline
+        self.trips = OrderedDict()  # set up again at the next reset()
+
+    def add_primary_agent(self, agent):
+        """Give another agent a trip of its own in each trial (e.g. more learning cabs); the trial ends when all trips have."""
+        if self.primary_agent is None:
+            self.primary_agent = agent
+        self.primary_agents.append(agent)
+        self.trips = OrderedDict()  # set up again at the next reset()
+
+    def use_scenarios(self, scenarios):
+        """Set up each following trial from the next of scenarios (e.g. a scenario.ScenarioFile), or at random if None.
+
+        Scenarios with a check(grid_size) method (as ScenarioFile has) are checked once, here, for their grid size
+        and for locations off the grid; ValueError if they do not fit. Scenarios with a read(count) method (as
+        ScenarioFile has) are read scenario_chunk_size at a time, others one at a time, as reset() needs them.
+        """
+        if scenarios is not None and hasattr(scenarios, 'check'):
+            scenarios.check(self.grid_size)
+        self.scenarios = scenarios
+        self._scenario_chunk = None
+        self._scenario_position = 0
+
+    def _next_scenario(self):
+        # the decoded chunk of scenarios (see _decode_scenarios()) holding the next scenario, and its index in it
+        chunk = self._scenario_chunk
+        k = self._scenario_position
+        if chunk is None or k >= chunk['count']:
+            if hasattr(self.scenarios, 'read'):
+                records = self.scenarios.read(self.scenario_chunk_size)
+            else:
+                records = np.array([next(self.scenarios)])
+            if len(records) == 0:
+                raise StopIteration
+            chunk = self._scenario_chunk = self._decode_scenarios(records)
+            k = 0
+        self._scenario_position = k + 1
+        return chunk, k
+
+    def _decode_scenarios(self, scenarios):
+        # columns of an array of scenario.scenario_dtype records as reset() applies them: lists (one per scenario)
+        # of small ints, with locations as indices into _cells; light states and periods as arrays; ValueError if
+        # they do not fit this environment
+        cols, rows = self.grid_size
+        wrong_size = np.flatnonzero((scenarios['grid_size'] != self.grid_size).any(axis=1))
+        if len(wrong_size) > 0:
+            raise ValueError("Environment.reset(): scenario for a {}x{} grid does not fit this environment ({}x{})".format(
+                scenarios['grid_size'][wrong_size[0]][0], scenarios['grid_size'][wrong_size[0]][1], cols, rows))
+        for field in ('start', 'destination', 'dummy_location'):
+            locations = scenarios[field]
+            if (locations < 1).any() or (locations[..., 0] > cols).any() or (locations[..., 1] > rows).any():
+                raise ValueError("Environment.reset(): scenario with a {} off the {}x{} grid".format(field, cols, rows))
+        if (scenarios['periods'] < 1).any():
+            raise ValueError("Environment.reset(): scenario with a light period of 0")
+        self.intersections.fit_periods(int(scenarios['periods'].max()))
+
+        def cells(locations):
+            return ((locations[..., 0].astype(np.int32) - 1) * rows + locations[..., 1] - 1).tolist()
+
+        return {
+            'count': len(scenarios),
+            'trips': scenarios['start'].shape[1],
+            'others': scenarios['dummy_location'].shape[1],
+            'start': cells(scenarios['start']),
+            'destination': cells(scenarios['destination']),
+            'heading': scenarios['heading'].tolist(),
+            'dummy_location': cells(scenarios['dummy_location']),
+            'dummy_heading': scenarios['dummy_heading'].tolist(),
+            'dummy_waypoint': scenarios['dummy_waypoint'].tolist(),
+            'lights': np.unpackbits(scenarios['lights'], axis=1, count=cols * rows).reshape(len(scenarios), cols, rows).astype(bool),
+            'periods': scenarios['periods'].astype(np.int32),
+            'scenarios': scenarios}  # as read, for traffic field cars
+
+    @property
+    def success(self):
+        """Whether the primary agent has reached its destination in this trial."""
+        trip = self.trips.get(self.primary_agent)
+        return trip is not None and trip['success']
 
     def reset(self):
         self.done = False
         self.t = 0
+        self.trial += 1
 
-        # Reset traffic lights
-        for traffic_light in self.intersections.itervalues():
-            traffic_light.reset()
+        chunk, k = self._next_scenario() if self.scenarios is not None else (None, 0)
+        num_cars = len(self.traffic) if self.traffic is not None else 0
+        if chunk is not None:
+            num_others = num_cars + len(self.agent_states) - len(self.primary_agents)  # traffic field cars first, then other agents
+            if chunk['trips'] < len(self.primary_agents) or chunk['others'] != num_others:
+                raise ValueError("Environment.reset(): scenario (for {} trips, {} other agents) does not fit this environment ({}, {})".format(
+                    chunk['trips'], chunk['others'], len(self.primary_agents), num_others))
+            cells = self._cells
 
-        # Pick a start and a destination
-        start = random.choice(self.intersections.keys())
-        destination = random.choice(self.intersections.keys())
-
-        # Ensure starting location and destination are not too close
-        while self.compute_dist(start, destination) < 4:
-            start = random.choice(self.intersections.keys())
-            destination = random.choice(self.intersections.keys())
-
-        start_heading = random.choice(self.valid_headings)
-        deadline = self.compute_dist(start, destination) * 5
-        print "Environment.reset(): Trial set up with start = {}, destination = {}, deadline = {}".format(start, destination, deadline)
+        # Reset traffic lights
+        if chunk is None:
+            self.intersections.reset()
+        else:
+            self.intersections.set_states(chunk['lights'][k], chunk['periods'][k])
+
+        # Reset trips (in place, once set up for the primary agents)
+        trips = self.trips
+        if not trips:
+            trips = self.trips = OrderedDict((agent, {'index': i}) for i, agent in enumerate(self.primary_agents))
+        for trip in trips.values():
+            trip['reward'] = 0.0
+            trip['penalties'] = 0
+            trip['success'] = False
+            trip['finished'] = False
+        self.parked.clear()
+
+        for i, agent in enumerate(self.primary_agents):
+            if chunk is None:
+                # Pick a start and a destination
+                start = self.intersections.random_intersection()
+                destination = self.intersections.random_intersection()
+
+                # Ensure starting location and destination are not too close
+                while self.compute_dist(start, destination) < 4:
+                    start = self.intersections.random_intersection()
+                    destination = self.intersections.random_intersection()
+
+                start_heading = self.random.choice(self.valid_headings)
+            else:
+                start = cells[chunk['start'][k][i]]
+                destination = cells[chunk['destination'][k][i]]
+                start_heading = self.valid_headings[chunk['heading'][k][i]]
+            deadline = self.compute_dist(start, destination) * 5
+            self.telemetry.log(TRIAL, "Environment.reset(): Trial set up with start = {}, destination = {}, deadline = {}", start, destination, deadline)
+            self.agent_states[agent].set(start, start_heading, destination, deadline)
 
         # Initialize agent(s)
-        for agent in self.agent_states.iterkeys():
-            self.agent_states[agent] = {
-                'location': start if agent is self.primary_agent else random.choice(self.intersections.keys()),
-                'heading': start_heading if agent is self.primary_agent else random.choice(self.valid_headings),
-                'destination': destination if agent is self.primary_agent else None,
-                'deadline': deadline if agent is self.primary_agent else None}
-            agent.reset(destination=(destination if agent is self.primary_agent else None))
+        self.occupancy.clear()
+        self.sense_cache.clear()
+        if self.traffic is not None:
+            if chunk is None:
+                self.traffic.reset()
+            else:
+                records = chunk['scenarios']
+                self.traffic.reset(records['dummy_location'][k, :num_cars], records['dummy_heading'][k, :num_cars], records['dummy_waypoint'][k, :num_cars])
+        if chunk is not None:
+            placement = num_cars  # next of the scenario's dummy placements
+            locations = chunk['dummy_location'][k]
+            headings = chunk['dummy_heading'][k]
+            waypoints = chunk['dummy_waypoint'][k]
+        for agent, state in self.agent_states.items():
+            if agent not in trips:
+                if chunk is None:
+                    state.set(self.intersections.random_intersection(), self.random.choice(self.valid_headings))
+                else:
+                    state.set(cells[locations[placement]], self.valid_headings[headings[placement]])
+                    agent.next_waypoint = self.valid_actions[waypoints[placement]]
+                    placement += 1
+            self._enter(agent, state.location)
+            agent.reset(destination=state.destination)
 
     def step(self):
-        #print "Environment.step(): t = {}".format(self.t)  # [debug]
+        #print("Environment.step(): t = {}".format(self.t))  # [debug]
+        profiling = profiler.enabled
+        if profiling:
+            start = phase_start = profiler.clock()
+        self.sense_cache.clear()  # lights and waypoints change from tick to tick
 
         # Update traffic lights
-        for intersection, traffic_light in self.intersections.iteritems():
-            traffic_light.update(self.t)
-
-        # Update agents
-        for agent in self.agent_states.iterkeys():
+        self.intersections.update(self.t)
+        if profiling:
+            phase_start = profiler.add('Environment.step.lights', phase_start)
+
+        # Update traffic field cars, then agents (except those parked after finishing their trip)
+        if self.traffic is not None:
+            self.traffic.step()
+            if profiling:
+                phase_start = profiler.add('Environment.step.dummies', phase_start)
+        parked = self.parked
+        for agent in self.agent_states.keys():
+            if parked and agent in parked:
+                continue
             agent.update(self.t)
+            if profiling:
+                phase_start = profiler.add('Environment.step.primary' if agent in self.trips else 'Environment.step.dummies', phase_start)
 
         self.t += 1
-        if self.primary_agent is not None:
-            agent_deadline = self.agent_states[self.primary_agent]['deadline']
-            if agent_deadline <= self.hard_time_limit:
-                self.done = True
-                print "Environment.step(): Primary agent hit hard time limit ({})! Trial aborted.".format(self.hard_time_limit)
-            elif self.enforce_deadline and agent_deadline <= 0:
-                self.done = True
-                print "Environment.step(): Primary agent ran out of time! Trial aborted."
-            self.agent_states[self.primary_agent]['deadline'] = agent_deadline - 1
+        if self.trips:
+            for agent, trip in self.trips.items():
+                if trip['finished']:
+                    continue
+                state = self.agent_states[agent]
+                agent_deadline = state.deadline
+                finished = trip['success']
+                if agent_deadline <= self.hard_time_limit:
+                    finished = True
+                    self.telemetry.log(TRIAL, "Environment.step(): Primary agent hit hard time limit ({})! Trial aborted.", self.hard_time_limit)
+                elif self.enforce_deadline and agent_deadline <= 0:
+                    finished = True
+                    self.telemetry.log(TRIAL, "Environment.step(): Primary agent ran out of time! Trial aborted.")
+                state.deadline = agent_deadline - 1
+                if finished:
+                    trip['finished'] = True
+                    self.telemetry.record_trial(trip['index'], self.trial, self.t, agent_deadline - 1, trip['success'], trip['reward'], trip['penalties'])
+                    self._leave(agent, state.location)
+                    parked.add(agent)
+            self.done = len(parked) == len(self.trips)
+        if profiling:
+            profiler.add('Environment.step', start)
+
+    def snapshot_dtype(self):
+        """Record type of a snapshot of this environment (for its current no. of agents and trips)."""
+        n, p = len(self.agent_states), len(self.trips)
+        m = len(self.traffic) if self.traffic is not None else 0
+        if self._snapshot_dtype is not None and self._snapshot_dtype[0] == (n, p):
+            return self._snapshot_dtype[1]
+        dtype = np.dtype([
+            ('t', np.int32),
+            ('trial', np.int32),
+            ('done', np.bool_),
+            ('light_t', np.int32),
+            ('light_phases', np.bool_, self.intersections.shape),
+            ('light_periods', np.int32, self.intersections.shape),
+            ('location', np.int32, (n, 2)),
+            ('heading', np.int8, (n,)),         # index into valid_headings
+            ('destination', np.int32, (n, 2)),  # (0, 0) = None
+            ('deadline', np.int32, (n,)),       # no_deadline = None
+            ('waypoint', np.int8, (n,)),        # index into valid_actions
+            ('trip_reward', np.float64, (p,)),
+            ('trip_penalties', np.int32, (p,)),
+            ('trip_success', np.bool_, (p,)),
+            ('trip_finished', np.bool_, (p,)),  # finished trips' agents are parked
+            ('car_x', np.int32, (m,)),          # traffic field cars, as in TrafficField
+            ('car_y', np.int32, (m,)),
+            ('car_heading', np.int8, (m,)),
+            ('car_waypoint', np.int8, (m,)),
+            ('random', np.uint32, (625,)),      # random.Random state
+            ('random_gauss', np.float64),       # NaN = None
+            ('traffic_key', np.uint32, (624,)),  # traffic_random: RandomState state, and its block of pre-drawn numbers
+            ('traffic_pos', np.int32),
+            ('traffic_gauss', np.float64),      # NaN = no cached gaussian
+            ('traffic_block', np.float64, (self.traffic_random.block_size,)),
+            ('traffic_block_len', np.int32),
+            ('traffic_index', np.int32)])
+        self._snapshot_dtype = ((n, p), dtype)
+        return dtype
+
+    def snapshot(self, out=None):
+        """Copy of the state of this environment as one record (0-d array) of snapshot_dtype(), to restore() later.
+
+        Covers time, lights, agent states, agents' next waypoints, trips, traffic field cars and the environment's random streams,
+        so stepping on from a restored snapshot replays exactly what followed it. Agents' own state (e.g.
+        learning agents' Q-tables and random streams) is not included. Pass out (e.g. an element of an array of
+        snapshots) to write into it instead of allocating a new record.
+        """
+        snapshot = out if out is not None else np.zeros((), dtype=self.snapshot_dtype())
+        snapshot['t'] = self.t
+        snapshot['trial'] = self.trial
+        snapshot['done'] = self.done
+        snapshot['light_t'] = self.intersections.t
+        snapshot['light_phases'] = self.intersections.phases
+        snapshot['light_periods'] = self.intersections.periods
+
+        states = list(self.agent_states.values())
+        heading_index = self._heading_index
+        action_index = self._action_index
+        snapshot['location'] = [state.location for state in states]
+        snapshot['heading'] = [heading_index[state.heading] for state in states]
+        snapshot['destination'] = [state.destination or (0, 0) for state in states]
+        snapshot['deadline'] = [state.deadline if state.deadline is not None else self.no_deadline for state in states]
+        snapshot['waypoint'] = [action_index[agent.next_waypoint] for agent in self.agent_states]
+
+        trips = list(self.trips.values())
+        snapshot['trip_reward'] = [trip['reward'] for trip in trips]
+        snapshot['trip_penalties'] = [trip['penalties'] for trip in trips]
+        snapshot['trip_success'] = [trip['success'] for trip in trips]
+        snapshot['trip_finished'] = [trip['finished'] for trip in trips]
+        if self.traffic is not None:
+            snapshot['car_x'] = self.traffic.x
+            snapshot['car_y'] = self.traffic.y
+            snapshot['car_heading'] = self.traffic.heading
+            snapshot['car_waypoint'] = self.traffic.waypoint
+
+        version, internal_state, gauss = self.random.getstate()
+        snapshot['random'] = np.frombuffer(array.array('I', internal_state), dtype=np.uint32)
+        snapshot['random_gauss'] = gauss if gauss is not None else np.nan
+        (name, key, pos, has_gauss, cached_gaussian), block, index = self.traffic_random.getstate()
+        snapshot['traffic_key'] = key
+        snapshot['traffic_pos'] = pos
+        snapshot['traffic_gauss'] = cached_gaussian if has_gauss else np.nan
+        snapshot['traffic_block'][:len(block)] = block
+        snapshot['traffic_block_len'] = len(block)
+        snapshot['traffic_index'] = index
+        return snapshot
+
+    def restore(self, snapshot):
+        """Return to the state saved by snapshot(); the snapshot itself is left unchanged, so it can be restored again.
+
+        The environment must have the same agents and trips as when the snapshot was taken. Telemetry recorded
+        since then is not undone.
+        """
+        if snapshot.dtype != self.snapshot_dtype():
+            raise ValueError("Environment.restore(): snapshot does not fit this environment ({} agents, {} trips)".format(
+                len(self.agent_states), len(self.trips)))
+        self.t = int(snapshot['t'])
+        self.trial = int(snapshot['trial'])
+        self.done = bool(snapshot['done'])
+        self.intersections.phases = snapshot['light_phases'].copy()
+        np.copyto(self.intersections.periods, snapshot['light_periods'])
+        self.intersections.update(int(snapshot['light_t']))
+
+        trip_agents = list(self.trips)
+        self.trips = OrderedDict((agent, {'index': i, 'reward': reward, 'penalties': penalties, 'success': success, 'finished': finished})
+                                 for i, (agent, reward, penalties, success, finished) in enumerate(zip(
+                                     trip_agents, snapshot['trip_reward'].tolist(), snapshot['trip_penalties'].tolist(),
+                                     snapshot['trip_success'].tolist(), snapshot['trip_finished'].tolist())))
+        self.parked = set(agent for agent, trip in self.trips.items() if trip['finished'])
+
+        occupancy = self.occupancy
+        occupancy.clear()
+        self.sense_cache.clear()
+        parked = self.parked
+        valid_headings = self.valid_headings
+        valid_actions = self.valid_actions
+        no_deadline = self.no_deadline
+        for (agent, state), location, heading, destination, deadline, waypoint in zip(
+                self.agent_states.items(), snapshot['location'].tolist(), snapshot['heading'].tolist(),
+                snapshot['destination'].tolist(), snapshot['deadline'].tolist(), snapshot['waypoint'].tolist()):
+            state.set(tuple(location), valid_headings[heading], tuple(destination) if destination[0] else None,
+                      deadline if deadline != no_deadline else None)
+            agent.next_waypoint = valid_actions[waypoint]
+            if agent not in parked:
+                occupancy.setdefault(state.location, []).append(agent)  # in creation order, as _enter() keeps it
+        versions = self.occupancy_version
+        for location in occupancy:
+            versions[location] = versions.get(location, 0) + 1
+        if self.traffic is not None:
+            self.traffic.x[:] = snapshot['car_x']
+            self.traffic.y[:] = snapshot['car_y']
+            self.traffic.heading[:] = snapshot['car_heading']
+            self.traffic.waypoint[:] = snapshot['car_waypoint']
+            self.traffic.index_cells()
+
+        gauss = float(snapshot['random_gauss'])
+        self.random.setstate((3, tuple(snapshot['random'].tolist()), gauss if gauss == gauss else None))
+        cached_gaussian = float(snapshot['traffic_gauss'])
+        has_gauss = cached_gaussian == cached_gaussian
+        self.traffic_random.setstate((('MT19937', snapshot['traffic_key'], int(snapshot['traffic_pos']), int(has_gauss), cached_gaussian if has_gauss else 0.0),
+                                      snapshot['traffic_block'][:int(snapshot['traffic_block_len'])], int(snapshot['traffic_index'])))
 
     def sense(self, agent):
         assert agent in self.agent_states, "Unknown agent!"
 
         state = self.agent_states[agent]
-        location = state['location']
-        heading = state['heading']
-        light = 'green' if (self.intersections[location].state and heading[1] != 0) or ((not self.intersections[location].state) and heading[0] != 0) else 'red'
-
-        # Populate oncoming, left, right
-        oncoming = None
-        left = None
-        right = None
-        for other_agent, other_state in self.agent_states.iteritems():
-            if agent == other_agent or location != other_state['location'] or (heading[0] == other_state['heading'][0] and heading[1] == other_state['heading'][1]):
-                continue
-            other_heading = other_agent.get_next_waypoint()
-            if (heading[0] * other_state['heading'][0] + heading[1] * other_state['heading'][1]) == -1:
-                if oncoming != 'left':  # we don't want to override oncoming == 'left'
-                    oncoming = other_heading
-            elif (heading[1] == other_state['heading'][0] and -heading[0] == other_state['heading'][1]):
-                if right != 'forward' and right != 'left':  # we don't want to override right == 'forward or 'left'
-                    right = other_heading
-            else:
-                if left != 'forward':  # we don't want to override left == 'forward'
-                    left = other_heading
-
-        return {'light': light, 'oncoming': oncoming, 'left': left, 'right': right}  # TODO: make this a namedtuple
+        location = state.location
+        version = self.occupancy_version[location]
+        cached = self.sense_cache.get(agent)
+        if cached is not None and cached[0] == location and cached[1] == version:
+            if profiler.enabled:
+                profiler.count('Environment.sense.cache_hits')
+            return cached[2]
+        if profiler.enabled:
+            start = profiler.clock()
+
+        heading = state.heading
+        light_state = self.intersections.state(location)
+        light = 'green' if (light_state and heading[1] != 0) or ((not light_state) and heading[0] != 0) else 'red'
+
+        # Populate oncoming, left, right (only agents and traffic field cars at the same intersection can affect these;
+        # the cars count first, as if created before all agents)
+        oncoming, left, right = self.traffic.sense(location, heading) if self.traffic is not None else (None, None, None)
+        occupants = self.occupancy[location]
+        if len(occupants) > 1:
+            agent_states = self.agent_states
+            others = [(agent_states[other_agent].heading, other_agent.get_next_waypoint()) for other_agent in occupants]
+            oncoming, left, right = sense_others(heading, others, oncoming, left, right)
+
+        inputs = {'light': light, 'oncoming': oncoming, 'left': left, 'right': right}  # TODO: make this a namedtuple
+        self.sense_cache[agent] = (location, version, inputs)
+        if profiler.enabled:
+            profiler.add('Environment.sense', start)
+        return inputs
 
     def get_deadline(self, agent):
-        return self.agent_states[agent]['deadline'] if agent is self.primary_agent else None
+        return self.agent_states[agent].deadline
 
     def act(self, agent, action):
         assert agent in self.agent_states, "Unknown agent!"
         assert action in self.valid_actions, "Invalid action!"
+        if profiler.enabled:
+            start = profiler.clock()
 
         state = self.agent_states[agent]
-        location = state['location']
-        heading = state['heading']
-        light = 'green' if (self.intersections[location].state and heading[1] != 0) or ((not self.intersections[location].state) and heading[0] != 0) else 'red'
+        location = state.location
+        heading = state.heading
+        light_state = self.intersections.state(location)
+        light = 'green' if (light_state and heading[1] != 0) or ((not light_state) and heading[0] != 0) else 'red'
         sense = self.sense(agent)
 
         # Move agent if within bounds and obeys traffic rules
@@ -189,8 +678,10 @@ class Environment(object):
                 location = ((location[0] + heading[0] - self.bounds[0]) % (self.bounds[2] - self.bounds[0] + 1) + self.bounds[0],
                             (location[1] + heading[1] - self.bounds[1]) % (self.bounds[3] - self.bounds[1] + 1) + self.bounds[1])  # wrap-around
                 #if self.bounds[0] <= location[0] <= self.bounds[2] and self.bounds[1] <= location[1] <= self.bounds[3]:  # bounded
-                state['location'] = location
-                state['heading'] = heading
+                self._leave(agent, state.location)
+                self._enter(agent, location)
+                state.location = location
+                state.heading = heading
                 reward = 2.0 if action == agent.get_next_waypoint() else -0.5  # valid, but is it correct? (as per waypoint)
             else:
                 # Valid null move
@@ -199,21 +690,44 @@ class Environment(object):
             # Invalid move
             reward = -1.0
 
-        if agent is self.primary_agent:
-            if state['location'] == state['destination']:
-                if state['deadline'] >= 0:
+        trip = self.trips.get(agent)
+        if trip is not None:
+            if location == state.destination:
+                if state.deadline >= 0:
                     reward += 10  # bonus
-                self.done = True
-                print "Environment.act(): Primary agent has reached destination!"  # [debug]
-            self.status_text = "state: {}\naction: {}\nreward: {}".format(agent.get_state(), action, reward)
-            #print "Environment.act() [POST]: location: {}, heading: {}, action: {}, reward: {}".format(location, heading, action, reward)  # [debug]
-
+                trip['success'] = True  # the trip ends (and the agent is parked) at the end of this step
+                self.telemetry.log(TRIAL, "Environment.act(): Primary agent has reached destination!")  # [debug]
+            trip['reward'] += reward
+            if reward < 0:
+                trip['penalties'] += 1
+            if agent is self.primary_agent:
+                self.status_text = "state: {}\naction: {}\nreward: {}".format(agent.get_state(), action, reward)
+            #print("Environment.act() [POST]: location: {}, heading: {}, action: {}, reward: {}".format(location, heading, action, reward))  # [debug]
+
+        if profiler.enabled:
+            profiler.add('Environment.act', start)
         return reward
 
     def compute_dist(self, a, b):
         """L1 distance between two points."""
         return abs(b[0] - a[0]) + abs(b[1] - a[1])
 
+    def _enter(self, agent, location):
+        """Add agent to the occupancy index at location, keeping creation order (sense() depends on it)."""
+        agents = self.occupancy.setdefault(location, [])
+        agents.append(agent)
+        if len(agents) > 1:
+            agents.sort(key=self._agent_order.__getitem__)
+        self.occupancy_version[location] = self.occupancy_version.get(location, 0) + 1
+
+    def _leave(self, agent, location):
+        """Remove agent from the occupancy index at location."""
+        agents = self.occupancy[location]
+        agents.remove(agent)
+        if not agents:
+            del self.occupancy[location]
+        self.occupancy_version[location] += 1
+
 
 class Agent(object):
     """Base class for all agents."""
@@ -242,8 +756,9 @@ class DummyAgent(Agent):
 
     def __init__(self, env):
         super(DummyAgent, self).__init__(env)  # sets self.env = env, state = None, next_waypoint = None, and a default color
-        self.next_waypoint = random.choice(Environment.valid_actions[1:])
-        self.color = random.choice(self.color_choices)
+        self.random = env.traffic_random  # one stream shared by all dummies (they are updated in a fixed order)
+        self.next_waypoint = self.random.choice(Environment.valid_actions[1:])
+        self.color = self.random.choice(self.color_choices)
 
     def update(self, t):
         inputs = self.env.sense(self)
@@ -262,7 +777,7 @@ class DummyAgent(Agent):
         action = None
         if action_okay:
             action = self.next_waypoint
-            self.next_waypoint = random.choice(Environment.valid_actions[1:])
+            self.next_waypoint = self.random.choice(Environment.valid_actions[1:])
         reward = self.env.act(self, action)
-        #print "DummyAgent.update(): t = {}, inputs = {}, action = {}, reward = {}".format(t, inputs, action, reward)  # [debug]
-        #print "DummyAgent.update(): next_waypoint = {}".format(self.next_waypoint)  # [debug]
+        #print("DummyAgent.update(): t = {}, inputs = {}, action = {}, reward = {}".format(t, inputs, action, reward))  # [debug]
+        #print("DummyAgent.update(): next_waypoint = {}".format(self.next_waypoint))  # [debug]
@@ -0,0 +1,131 @@
+import argparse
+
+import numpy as np
+
+from .environment import Environment
+from .batch_environment import BatchEnvironment
+from .qtable import StateEncoder, QTable
+from .profiler import Profiler
+
+# LearningAgent action index order (see LearningAgent.get_action_label)
+learner_actions = [None, 'left', 'forward', 'right']
+learner_to_env = np.array([Environment.valid_actions.index(action) for action in learner_actions], dtype=np.int32)
+
+
+def compile_policy(q_table):
+    """Flat state index -> action lookup array (indices into Environment.valid_actions) for greedy driving.
+
+    States without a learned policy fall back to the first action with the max Q value (None for unvisited states),
+    so evaluation is deterministic.
+    """
+    policy = np.asarray(q_table.policy).astype(np.int32)
+    greedy = np.where(policy >= 0, policy, np.asarray(q_table.q_hat).argmax(axis=1))
+    return learner_to_env[greedy]
+
+
+def encode_states(batch, encoder, use_custom_direction):
+    """StateEncoder state index of the primary cab in every world of a BatchEnvironment."""
+    if use_custom_direction:
+        direction = batch.routes.direction[batch.route_index()]
+    else:
+        waypoint_direction = np.array([-1] + [encoder.directions.index(action) for action in Environment.valid_actions[1:]])
+        direction = waypoint_direction[batch.waypoint[:, batch.primary]]
+    inputs = batch.inputs
+    return encoder.encode_indices(direction, inputs['light'], inputs['oncoming'], inputs['left'], inputs['right'])
+
+
+def evaluate(q_table, num_trials, num_worlds=1000, use_custom_direction=None, grid_size=(8, 6), num_dummies=3, seed=None):
+    """Drive the primary cab greedily with a frozen Q-table for at least num_trials trials (deadline enforced).
+
+    Trials run in parallel in a BatchEnvironment, the same number in each world; nothing is learned and there is
+    no exploration. use_custom_direction defaults to the state layout matching the Q-table's size.
+    Returns per-trial arrays: success, penalties, margin (deadline left when the trial ended) and steps.
+    """
+    if use_custom_direction is None:
+        use_custom_direction = len(q_table.q_hat) == StateEncoder(use_custom_direction=True).num_states
+    encoder = StateEncoder(use_custom_direction=use_custom_direction)
+    if len(q_table.q_hat) != encoder.num_states:
+        raise ValueError("evaluate(): Q-table has {} states, expected {}".format(len(q_table.q_hat), encoder.num_states))
+    policy = compile_policy(q_table)
+
+    num_worlds = min(num_worlds, num_trials)
+    trials_per_world = -(-num_trials // num_worlds)
+    batch = BatchEnvironment(num_worlds, grid_size=grid_size, num_dummies=num_dummies, enforce_deadline=True, auto_reset=False, seed=seed)
+    batch.reset()
+
+    total = num_worlds * trials_per_world
+    results = {
+        'success': np.zeros(total, dtype=bool),
+        'penalties': np.zeros(total, dtype=np.int32),
+        'margin': np.zeros(total, dtype=np.int32),
+        'steps': np.zeros(total, dtype=np.int32)}
+    trial_penalties = np.zeros(num_worlds, dtype=np.int32)
+    count = 0
+
+    while not batch.done.all():
+        rewards, finished = batch.step(policy[encode_states(batch, encoder, use_custom_direction)])
+        trial_penalties += rewards < 0
+        idx = np.flatnonzero(finished)
+        if len(idx):
+            rows = slice(count, count + len(idx))
+            results['success'][rows] = batch.success[idx]
+            results['penalties'][rows] = trial_penalties[idx]
+            results['margin'][rows] = batch.deadline[idx]
+            results['steps'][rows] = batch.t[idx]
+            count += len(idx)
+            trial_penalties[idx] = 0
+            batch.reset(finished & (batch.trials < trials_per_world))
+    return results
+
+
+def summarize(results):
+    """Success rate, and penalty and deadline margin (of successful trials) distributions as percentiles."""
+    percentiles = [0, 10, 25, 50, 75, 90, 100]
+    success = results['success']
+    summary = {
+        'trials': len(success),
+        'success_rate': success.mean(),
+        'penalties': int(results['penalties'].sum()),
+        'trials_with_penalties': (results['penalties'] > 0).mean(),
+        'mean_steps_to_goal': results['steps'][success].mean() if success.any() else float('nan'),
+        'percentiles': percentiles,
+        'penalty_percentiles': np.percentile(results['penalties'], percentiles).tolist()}
+    summary['margin_percentiles'] = np.percentile(results['margin'][success], percentiles).tolist() if success.any() else None
+    return summary
+
+
+def format_report(summary):
+    lines = [
+        "trials:                {}".format(summary['trials']),
+        "success rate:          {:.4f}".format(summary['success_rate']),
+        "penalties:             {} ({:.4f} of trials had any)".format(summary['penalties'], summary['trials_with_penalties']),
+        "mean steps to goal:    {:.2f}".format(summary['mean_steps_to_goal']),
+        "",
+        "{:<22} ".format('percentile') + " ".join("{:>6}".format(p) for p in summary['percentiles']),
+        "{:<22} ".format('penalties per trial') + " ".join("{:>6.0f}".format(v) for v in summary['penalty_percentiles'])]
+    if summary['margin_percentiles'] is not None:
+        lines.append("{:<22} ".format('deadline margin') + " ".join("{:>6.0f}".format(v) for v in summary['margin_percentiles']))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate a trained policy (a LearningAgent checkpoint) greedily, without exploration or learning.")
+    parser.add_argument('checkpoint', help="checkpoint directory, as written with LearningAgent(checkpoint_path=...)")
+    parser.add_argument('--trials', type=int, default=10000, help="no. of evaluation trials (default: 10000)")
+    parser.add_argument('--worlds', type=int, default=1000, help="worlds simulated in parallel (default: 1000)")
+    parser.add_argument('--dummies', type=int, default=3, help="dummy cabs per world (default: 3)")
+    parser.add_argument('--grid', type=int, nargs=2, default=[8, 6], metavar=('COLS', 'ROWS'), help="grid size (default: 8 6)")
+    parser.add_argument('--seed', type=int, default=None, help="random seed")
+    args = parser.parse_args()
+
+    q_table = QTable.load(args.checkpoint, mmap_mode='r')
+    start = Profiler.clock()
+    results = evaluate(q_table, args.trials, num_worlds=args.worlds, grid_size=tuple(args.grid), num_dummies=args.dummies, seed=args.seed)
+    elapsed = Profiler.clock() - start
+    print(format_report(summarize(results)))
+    print()
+    print("{:.2f}s ({:.0f} trials/sec)".format(elapsed, len(results['success']) / max(elapsed, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from .environment import Environment
+from .simulator import Simulator
+from .agent import LearningAgent
+from .qtable import StateEncoder, QTable
+from .telemetry import QUIET
+from .profiler import Profiler
+from .sweep import tunable_params, format_table
+
+
+class SharedQTable(QTable):
+    """QTable whose arrays live in shared memory (RawArray), so that worker processes update one table.
+
+    With locks=None updates are lock-free (a concurrent update of the same entry may be lost, which Q-learning
+    tolerates); otherwise states are striped over the given locks, and each update holds its state's lock.
+    """
+
+    def __init__(self, q_buffer, policy_buffer, num_actions, locks=None):
+        super(SharedQTable, self).__init__(q_hat=np.frombuffer(q_buffer, dtype=np.float64).reshape(-1, num_actions),
+                                           policy=np.frombuffer(policy_buffer, dtype=np.int8))
+        self.q_buffer = q_buffer
+        self.policy_buffer = policy_buffer
+        self.locks = locks
+
+    @classmethod
+    def create(cls, num_states, num_actions, num_locks=0):
+        q_buffer = multiprocessing.RawArray('d', num_states * num_actions)
+        policy_buffer = multiprocessing.RawArray('b', num_states)
+        locks = [multiprocessing.Lock() for i in range(num_locks)] if num_locks > 0 else None
+        table = cls(q_buffer, policy_buffer, num_actions, locks)
+        table.policy[:] = -1
+        return table
+
+    def buffers(self):
+        """Arguments to rebuild this table in a worker process: SharedQTable(*table.buffers())."""
+        return self.q_buffer, self.policy_buffer, self.q_hat.shape[1], self.locks
+
+    def update(self, state, action, reward, next_state, learning_rate, discount_rate):
+        if self.locks is None:
+            return super(SharedQTable, self).update(state, action, reward, next_state, learning_rate, discount_rate)
+        with self.locks[state % len(self.locks)]:
+            super(SharedQTable, self).update(state, action, reward, next_state, learning_rate, discount_rate)
+
+    def batch_update(self, states, actions, rewards, next_states, learning_rate, discount_rate):
+        if self.locks is None:
+            return super(SharedQTable, self).batch_update(states, actions, rewards, next_states, learning_rate, discount_rate)
+        for lock in self.locks:  # a batch touches states of any stripe; always acquired in the same order
+            lock.acquire()
+        try:
+            super(SharedQTable, self).batch_update(states, actions, rewards, next_states, learning_rate, discount_rate)
+        finally:
+            for lock in reversed(self.locks):
+                lock.release()
+
+
+def train_worker(worker_id, buffers, params, n_trials, report_interval, seed, results, progress=None):
+    """Train a LearningAgent in its own Environment against the shared Q-table; report progress to the results queue.
+
+    progress (as read from a checkpoint's progress.json) resumes the exploration rate and trial count it was saved with.
+    """
+    try:
+        e = Environment(seed=seed)
+        e.telemetry.level = QUIET
+        q_table = SharedQTable(*buffers)
+        q_table.rng = e.spawn_random()
+        a = e.create_agent(LearningAgent, q_table=q_table, **params)
+        if progress is not None:
+            a.exploration_rate = progress["exploration_rate"]
+            a.trial_count = progress["trial_count"]
+        e.set_primary_agent(a, enforce_deadline=True)
+        sim = Simulator(e, display=False, fast_forward=True)
+        a.sim = sim
+
+        trials = steps = 0
+        while trials < n_trials:
+            stats = sim.run(n_trials=min(report_interval, n_trials - trials))
+            trials += stats['trials']
+            steps += stats['steps']
+            results.put({
+                'worker': worker_id,
+                'trials': trials,
+                'steps': steps,
+                'successes': a.destination_reached_count,
+                'penalties': a.penalty_count,
+                'exploration_rate': a.exploration_rate})
+            if sim.quit:
+                break
+    finally:
+        results.put({'worker': worker_id, 'finished': True})  # also if the worker failed, so the coordinator doesn't wait for it
+
+
+def train(n_trials, workers=None, params=None, num_locks=0, checkpoint_path=None, checkpoint_interval=100, report_interval=10, seed=0):
+    """Train n_trials trials, split over worker processes that share one Q-table.
+
+    The coordinating (calling) process collects per-worker progress and, if checkpoint_path is given, saves the
+    table every checkpoint_interval trials and at the end. An existing checkpoint there is warm-started from, like
+    LearningAgent.load_checkpoint() does: workers resume its exploration rate, and the trial, success and penalty
+    counts saved go on from its own. Returns (q_table, per-worker metrics) for this run's trials.
+    """
+    workers = workers if workers is not None else multiprocessing.cpu_count()
+    params = params if params is not None else {}
+    encoder = StateEncoder(use_custom_direction=params.get('useCustomDirection', LearningAgent.useCustomDirection))
+    q_table = SharedQTable.create(encoder.num_states, len(Environment.valid_actions), num_locks)
+    progress = None
+    if checkpoint_path is not None and QTable.exists(checkpoint_path):
+        saved = QTable.load(checkpoint_path, mmap_mode='r')
+        q_table.q_hat[:] = saved.q_hat
+        q_table.policy[:] = saved.policy
+        progress = QTable.load_progress(checkpoint_path)
+
+    results = multiprocessing.Queue()
+    processes = []
+    for i in range(workers):
+        worker_trials = n_trials // workers + (1 if i < n_trials % workers else 0)
+        process = multiprocessing.Process(target=train_worker, args=(i, q_table.buffers(), params, worker_trials, report_interval, seed + i, results, progress))
+        process.start()
+        processes.append(process)
+
+    metrics = {}
+    running = workers
+    last_checkpoint = 0
+    try:
+        while running > 0:
+            result = results.get()
+            if result.get('finished'):
+                running -= 1
+                continue
+            metrics[result['worker']] = result
+            total = sum(m['trials'] for m in metrics.values())
+            if checkpoint_path is not None and total - last_checkpoint >= checkpoint_interval:
+                save_checkpoint(q_table, metrics, checkpoint_path, progress)
+                last_checkpoint = total
+    finally:
+        for process in processes:
+            process.join()
+    if checkpoint_path is not None:
+        save_checkpoint(q_table, metrics, checkpoint_path, progress)
+    return q_table, [metrics[i] for i in sorted(metrics)]
+
+
+def save_checkpoint(q_table, metrics, path, resumed=None):
+    """Save the shared table, with progress in the format LearningAgent.load_checkpoint() reads.
+
+    Counts are cumulative: those in resumed (the progress of the checkpoint this run warm-started from) plus the workers'.
+    """
+    q_table.save(path)
+    resumed = resumed if resumed is not None else {"exploration_rate": LearningAgent.max_exploration_rate, "trial_count": 0,
+                                                   "destination_reached_count": 0, "penalty_count": 0}
+    QTable.save_progress(path,
+                         exploration_rate=min([m['exploration_rate'] for m in metrics.values()], default=resumed["exploration_rate"]),
+                         trial_count=resumed["trial_count"] + sum(m['trials'] for m in metrics.values()),
+                         destination_reached_count=resumed["destination_reached_count"] + sum(m['successes'] for m in metrics.values()),
+                         penalty_count=resumed["penalty_count"] + sum(m['penalties'] for m in metrics.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train one Q-table with several worker processes, each simulating its own environment.")
+    parser.add_argument('--trials', type=int, default=LearningAgent.num_of_trials, help="total no. of trials over all workers (default: {})".format(LearningAgent.num_of_trials))
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: no. of CPUs)")
+    parser.add_argument('--locks', type=int, default=0, help="no. of striped locks guarding Q-table updates (default: 0, lock-free)")
+    parser.add_argument('--checkpoint', default=None, metavar='DIR', help="checkpoint directory to warm-start from and save to")
+    parser.add_argument('--checkpoint-interval', type=int, default=100, help="save a checkpoint every this many trials (default: 100)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the first worker; worker i uses seed + i (default: 0)")
+    for name, value_type in tunable_params:
+        if name != 'num_of_trials':
+            parser.add_argument('--' + name, type=value_type, default=None, metavar='VALUE', help="LearningAgent parameter (default: {})".format(getattr(LearningAgent, name)))
+    args = parser.parse_args()
+
+    params = {name: getattr(args, name) for name, value_type in tunable_params if name != 'num_of_trials' and getattr(args, name) is not None}
+    start = Profiler.clock()
+    q_table, metrics = train(args.trials, workers=args.workers, params=params, num_locks=args.locks,
+                             checkpoint_path=args.checkpoint, checkpoint_interval=args.checkpoint_interval, seed=args.seed)
+    elapsed = Profiler.clock() - start
+
+    for m in metrics:
+        m['success_rate'] = m['successes'] * 1.0 / max(m['trials'], 1)
+    print(format_table(metrics, ['worker', 'trials', 'steps', 'successes', 'success_rate', 'penalties', 'exploration_rate']))
+    trials, steps = sum(m['trials'] for m in metrics), sum(m['steps'] for m in metrics)
+    print()
+    print("{} trials, {} steps in {:.2f}s ({:.1f} trials/sec)".format(trials, steps, elapsed, trials / max(elapsed, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
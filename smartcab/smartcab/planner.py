@@ -1,38 +1,116 @@
-import random
+import numpy as np
+
+from .environment import Environment
+from .telemetry import DEBUG
+from .profiler import profiler
+
+
+class RouteTable(object):
+    """Shortest-path next waypoints on the wrap-around grid, precomputed once per grid size.
+
+    The grid wraps around in both directions, so the best move depends only on the cab's heading and
+    on the offset of the destination from its location (mod grid size); tables are indexed by
+    [heading index, dx, dy]. Cabs cannot U-turn in place, so trip lengths account for heading:
+    reaching a destination straight behind costs two extra steps.
+    """
+
+    waypoints = Environment.valid_actions  # next_hop values index into this
+    headings = Environment.valid_headings
+    directions = ["Fo", "Fo/Ri", "Ri", "Ri/Ba", "Ba", "Ba/Le", "Le", "Fo/Le"]  # direction to destination, relative to heading; direction values index into this
+
+    _tables = {}  # grid_size -> RouteTable
+
+    @classmethod
+    def get(cls, grid_size):
+        """Shared table for a (cols, rows) grid, built on first use."""
+        if grid_size not in cls._tables:
+            cls._tables[grid_size] = cls(grid_size)
+        return cls._tables[grid_size]
+
+    def __init__(self, grid_size):
+        self.grid_size = grid_size
+        self.cols, self.rows = grid_size
+        self.heading_index = {heading: i for i, heading in enumerate(self.headings)}
+
+        dx, dy = np.meshgrid(np.arange(self.cols), np.arange(self.rows), indexing='ij')
+        forward, left, right = [self.waypoints.index(a) for a in ('forward', 'left', 'right')]
+
+        # Trip length from each (heading, offset): split the offset into distance ahead (a) and to the right (b),
+        # going either way round; a destination straight behind (a < 0, b == 0) needs a detour of 2
+        self.distance = np.zeros((4,) + grid_size, dtype=np.int32)
+        for k, (hx, hy) in enumerate(self.headings):
+            along, along_size = ((dx * hx) % self.cols, self.cols) if hx != 0 else ((dy * hy) % self.rows, self.rows)
+            lateral, lateral_size = ((dy * hx) % self.rows, self.rows) if hx != 0 else ((dx * -hy) % self.cols, self.cols)
+            candidates = []
+            for a in (along, along - along_size):
+                for b in (lateral, lateral - lateral_size):
+                    candidates.append(np.abs(a) + np.abs(b) + 2 * ((a < 0) & (b == 0)))
+            self.distance[k] = np.minimum.reduce(candidates)
+
+        # Next waypoint: the move that leads to the shortest remaining trip (ties: forward, then right, then left)
+        self.next_hop = np.zeros((4,) + grid_size, dtype=np.int8)
+        for k in range(4):
+            best = None
+            for action, turn in ((forward, 0), (right, 3), (left, 1)):
+                k_next = (k + turn) % 4
+                length = np.roll(self.distance[k_next], self.headings[k_next], axis=(0, 1))
+                if best is None:
+                    best, self.next_hop[k] = length, action
+                else:
+                    shorter = length < best
+                    best = np.where(shorter, length, best)
+                    self.next_hop[k][shorter] = action
+        self.next_hop[:, 0, 0] = self.waypoints.index(None)
+
+        # Direction to destination along the shortest wrapped offsets, in 8 compass sectors (N = 0, clockwise),
+        # rotated into the cab's frame (Fo = 0, clockwise); -1 at the destination
+        up, down = (-dy) % self.rows, dy % self.rows
+        rightwards, leftwards = dx % self.cols, (-dx) % self.cols
+        vertical = np.where(up <= down, up, -down)  # > 0: north
+        horizontal = np.where(rightwards <= leftwards, rightwards, -leftwards)  # > 0: east
+        sector = np.select(
+            [(vertical == 0) & (horizontal == 0), vertical == 0, horizontal == 0, horizontal > 0],
+            [-1, np.where(horizontal < 0, 6, 2), np.where(vertical < 0, 4, 0), np.where(vertical < 0, 3, 1)],
+            np.where(vertical < 0, 5, 7))
+        self.direction = np.zeros((4,) + grid_size, dtype=np.int8)
+        for k, heading in enumerate(self.headings):
+            rotation = {(0, -1): 0, (1, 0): 2, (0, 1): 4, (-1, 0): 6}[heading]
+            self.direction[k] = np.where(sector < 0, -1, (sector - rotation) % 8)
+
+    def index(self, location, heading, destination):
+        """Table index for a cab at location with heading, going to destination."""
+        return self.heading_index[heading], (destination[0] - location[0]) % self.cols, (destination[1] - location[1]) % self.rows
+
+    def next_waypoint(self, location, heading, destination):
+        return self.waypoints[self.next_hop[self.index(location, heading, destination)]]
+
+    def trip_length(self, location, heading, destination):
+        return self.distance[self.index(location, heading, destination)]
+
+    def direction_to(self, location, heading, destination):
+        """Direction label (e.g. "Fo/Ri") of destination as seen from the cab, or "" at the destination."""
+        direction = self.direction[self.index(location, heading, destination)]
+        return self.directions[direction] if direction >= 0 else ""
+
 
 class RoutePlanner(object):
-    """Silly route planner that is meant for a perpendicular grid network."""
+    """Shortest-path route planner for the wrap-around grid network, backed by a shared RouteTable."""
 
     def __init__(self, env, agent):
         self.env = env
         self.agent = agent
         self.destination = None
+        self.routes = RouteTable.get(env.grid_size)
 
     def route_to(self, destination=None):
-        self.destination = destination if destination is not None else random.choice(self.env.intersections.keys())
-        print "RoutePlanner.route_to(): destination = {}".format(destination)  # [debug]
+        self.destination = destination if destination is not None else self.env.intersections.random_intersection()
+        self.env.telemetry.log(DEBUG, "RoutePlanner.route_to(): destination = {}", destination)  # [debug]
 
     def next_waypoint(self):
-        location = self.env.agent_states[self.agent]['location']
-        heading = self.env.agent_states[self.agent]['heading']
-        delta = (self.destination[0] - location[0], self.destination[1] - location[1])
-        if delta[0] == 0 and delta[1] == 0:
-            return None
-        elif delta[0] != 0:  # EW difference
-            if delta[0] * heading[0] > 0:  # facing correct EW direction
-                return 'forward'
-            elif delta[0] * heading[0] < 0:  # facing opposite EW direction
-                return 'right'  # long U-turn
-            elif delta[0] * heading[1] > 0:
-                return 'left'
-            else:
-                return 'right'
-        elif delta[1] != 0:  # NS difference (turn logic is slightly different)
-            if delta[1] * heading[1] > 0:  # facing correct NS direction
-                return 'forward'
-            elif delta[1] * heading[1] < 0:  # facing opposite NS direction
-                return 'right'  # long U-turn
-            elif delta[1] * heading[0] > 0:
-                return 'right'
-            else:
-                return 'left'
+        if profiler.enabled:
+            start = profiler.clock()
+        state = self.env.agent_states[self.agent]
+        waypoint = self.routes.next_waypoint(state.location, state.heading, self.destination)
+        if profiler.enabled:
+            profiler.add('RoutePlanner.next_waypoint', start)
+        return waypoint
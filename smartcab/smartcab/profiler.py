@@ -0,0 +1,72 @@
+import time
+import json
+
+
+class Profiler(object):
+    """Named phase timers and event counters for the simulation hot paths.
+
+    Instrumented code checks the enabled flag before reading the clock, so a disabled profiler costs a
+    single attribute lookup per phase:
+
+        if profiler.enabled:
+            start = profiler.clock()
+        ...  # phase
+        if profiler.enabled:
+            profiler.add('Environment.step.lights', start)
+
+    Phase names are dotted by call site; phases nest (e.g. Environment.sense runs inside
+    Environment.step.dummies), so totals of different phases are not additive.
+    """
+
+    clock = staticmethod(getattr(time, 'perf_counter', time.time))
+
+    def __init__(self):
+        self.enabled = False
+        self.totals = {}  # phase -> total seconds
+        self.calls = {}   # phase or counter -> no. of calls/events
+
+    def enable(self, reset=True):
+        if reset:
+            self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.totals = {}
+        self.calls = {}
+
+    def add(self, name, start):
+        """Add the time since start to phase name; returns the current clock, to chain consecutive phases."""
+        now = self.clock()
+        self.totals[name] = self.totals.get(name, 0.0) + (now - start)
+        self.calls[name] = self.calls.get(name, 0) + 1
+        return now
+
+    def count(self, name, n=1):
+        self.calls[name] = self.calls.get(name, 0) + n
+
+    def results(self):
+        """{name: {'calls': n, 'total': seconds or None for counters}}"""
+        return {name: {'calls': calls, 'total': self.totals.get(name)} for name, calls in self.calls.items()}
+
+    def report(self, reference='Environment.step'):
+        """Per-phase breakdown as a text table, slowest first, with each phase's share of the reference phase."""
+        reference_total = self.totals.get(reference)
+        lines = ["{:<40} {:>10} {:>12} {:>12} {:>8}".format('phase', 'calls', 'total (ms)', 'mean (us)', '%')]
+        for name in sorted(self.totals, key=self.totals.get, reverse=True):
+            total, calls = self.totals[name], self.calls[name]
+            share = "{:.1f}".format(100.0 * total / reference_total) if reference_total else "-"
+            lines.append("{:<40} {:>10} {:>12.2f} {:>12.2f} {:>8}".format(name, calls, total * 1e3, total * 1e6 / calls, share))
+        for name in sorted(name for name in self.calls if name not in self.totals):
+            lines.append("{:<40} {:>10}".format(name, self.calls[name]))
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """Write results as JSON (sorted keys, so reports from different builds can be diffed)."""
+        with open(path, 'w') as f:
+            json.dump(self.results(), f, indent=2, sort_keys=True)
+
+
+profiler = Profiler()  # shared by all instrumented modules; off by default
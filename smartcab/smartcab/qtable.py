@@ -0,0 +1,135 @@
+import os
+import json
+import itertools
+
+import numpy as np
+
+from .rng import BlockRandom
+
+
+class StateEncoder(object):
+    """Maps (direction to destination, light, intersection traffic) to a small integer state index.
+
+    State indices are laid out as direction * 16 + light * 8 + traffic, where traffic is a bitmask of
+    which of oncoming (1), left (2) and right (4) are occupied; the last index is the GOAL state.
+    Human-readable labels (e.g. "forward-GRN-O/L") are kept in labels for debug output.
+    """
+
+    direction_custom = ["Fo", "Fo/Ri", "Ri", "Ri/Ba", "Ba", "Ba/Le", "Le", "Fo/Le"]  # shortest direction to destination calculated using a custom function
+    direction_waypoint = ["forward", "left", "right"]                                # shortest direction to destination gotten as waypoint from planner
+    traffic_light = ["RED", "GRN"]                                                   # traffic light at intersection
+    traffic_intersection = ["N", "O", "L", "O/L", "R", "O/R", "L/R", "O/L/R"]        # traffic situation with other cabs at intersection, by bitmask
+
+    def __init__(self, use_custom_direction=False):
+        self.directions = self.direction_custom if use_custom_direction else self.direction_waypoint
+        self.num_states = len(self.directions) * len(self.traffic_light) * len(self.traffic_intersection) + 1
+        self.goal = self.num_states - 1
+        self.labels = ["{}-{}-{}".format(a, b, c) for a, b, c in itertools.product(self.directions, self.traffic_light, self.traffic_intersection)]
+        self.labels.append("GOAL")
+        self._direction_offset = {direction: i * 16 for i, direction in enumerate(self.directions)}
+
+    def encode(self, direction, inputs):
+        """State index for a direction label (None or "" at the destination) and sensed inputs."""
+        if not direction:
+            return self.goal
+        return (self._direction_offset[direction] + (8 if inputs['light'] == 'green' else 0) +
+                (inputs['oncoming'] is not None) + 2 * (inputs['left'] is not None) + 4 * (inputs['right'] is not None))
+
+    def encode_indices(self, direction, green, oncoming, left, right):
+        """Vectorized encode(): direction as indices into directions (-1 at the destination), green as booleans and
+        oncoming/left/right as indices into Environment.valid_actions (0 = None)."""
+        state = direction * 16 + green * 8 + (oncoming != 0) + 2 * (left != 0) + 4 * (right != 0)
+        return np.where(direction < 0, self.goal, state)
+
+    def label(self, state):
+        return self.labels[state]
+
+
+class QTable(object):
+    """Tabular Q-values and greedy policy stored in contiguous NumPy arrays, indexed by state index."""
+
+    def __init__(self, num_states=None, num_actions=4, q_hat=None, policy=None, rng=None):
+        # either allocate a fresh table, or wrap existing arrays (e.g. memory-mapped from a checkpoint)
+        self.q_hat = q_hat if q_hat is not None else np.zeros((num_states, num_actions), dtype=np.float64)
+        self.policy = policy if policy is not None else np.full(len(self.q_hat), -1, dtype=np.int8)  # -1 = no action learned yet
+        self.rng = rng if rng is not None else BlockRandom()  # for breaking ties between best actions
+
+    def save(self, path):
+        """Write Q-values and policy as .npy files in directory path, atomically replacing earlier ones."""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name, array in (('q_hat', self.q_hat), ('policy', self.policy)):
+            filename = os.path.join(path, name + '.npy')
+            with open(filename + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.rename(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, path, mmap_mode='c'):
+        """Table memory-mapped from files written by save().
+
+        mmap_mode 'c' (copy-on-write) keeps updates in memory, 'r' makes the table read-only and
+        'r+' writes updates through to the files.
+        """
+        return cls(q_hat=np.load(os.path.join(path, 'q_hat.npy'), mmap_mode=mmap_mode),
+                   policy=np.load(os.path.join(path, 'policy.npy'), mmap_mode=mmap_mode))
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'q_hat.npy')) and os.path.exists(os.path.join(path, 'policy.npy'))
+
+    @staticmethod
+    def save_progress(path, exploration_rate, trial_count, destination_reached_count, penalty_count):
+        """Write the exploration state saved with a table as progress.json in directory path, atomically replacing an earlier one."""
+        progress = {
+            "exploration_rate": exploration_rate,
+            "trial_count": trial_count,
+            "destination_reached_count": destination_reached_count,
+            "penalty_count": penalty_count
+        }
+        filename = os.path.join(path, 'progress.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(progress, f, indent=2, sort_keys=True)
+        os.rename(filename + '.tmp', filename)
+
+    @staticmethod
+    def load_progress(path):
+        """Exploration state written by save_progress(), as a dict with its arguments as keys, or None if there is none."""
+        filename = os.path.join(path, 'progress.json')
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as f:
+            return json.load(f)
+
+    def update(self, state, action, reward, next_state, learning_rate, discount_rate):
+        """Q-learning update for one transition, then make the policy greedy for state."""
+        new_q_hat = reward + (discount_rate * self.q_hat[next_state].max())
+        self.q_hat[state, action] = ((1 - learning_rate) * self.q_hat[state, action]) + (learning_rate * new_q_hat)
+        self.update_policy(state)
+
+    def batch_update(self, states, actions, rewards, next_states, learning_rate, discount_rate):
+        """Vectorized Q-learning update for a mini-batch of transitions, then make the policy greedy for their states.
+
+        Targets are computed from the Q values before the update; transitions sharing a (state, action) pair
+        are averaged into a single update of that pair.
+        """
+        num_actions = self.q_hat.shape[1]
+        targets = rewards + discount_rate * self.q_hat[next_states].max(axis=1)
+        pairs = states.astype(np.intp) * num_actions + actions
+        counts = np.bincount(pairs, minlength=self.q_hat.size)
+        sums = np.bincount(pairs, weights=targets, minlength=self.q_hat.size)
+        updated = np.flatnonzero(counts)
+        q = self.q_hat.reshape(-1)
+        q[updated] = (1 - learning_rate) * q[updated] + learning_rate * (sums[updated] / counts[updated])
+
+        # greedy policy for the updated states, ties broken randomly
+        updated_states = np.unique(updated // num_actions)
+        rows = self.q_hat[updated_states]
+        best = rows == rows.max(axis=1)[:, None]
+        self.policy[updated_states] = (best * self.rng.random_state.random_sample(best.shape)).argmax(axis=1)
+
+    def update_policy(self, state):
+        """Set the policy for state to its action with the max Q value, breaking ties randomly."""
+        row = self.q_hat[state].copy()  # the table may be shared with other processes updating it
+        best = np.flatnonzero(row == row.max())
+        self.policy[state] = best[0] if len(best) == 1 else self.rng.choice(best)
@@ -0,0 +1,37 @@
+import numpy as np
+
+
+class ReplayBuffer(object):
+    """Fixed-capacity ring buffer of (state, action, reward, next_state) transitions stored in NumPy arrays.
+
+    Once full, each new transition overwrites the oldest one.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.states = np.zeros(capacity, dtype=np.int32)
+        self.actions = np.zeros(capacity, dtype=np.int8)
+        self.rewards = np.zeros(capacity, dtype=np.float64)
+        self.next_states = np.zeros(capacity, dtype=np.int32)
+        self.size = 0      # no. of transitions stored
+        self.position = 0  # where the next transition goes
+
+    def __len__(self):
+        return self.size
+
+    def add(self, state, action, reward, next_state):
+        i = self.position
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_states[i] = next_state
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, batch_size, random_state=np.random):
+        """Uniformly sampled (with replacement) mini-batch: (states, actions, rewards, next_states) arrays.
+
+        Pass a seeded RandomState (e.g. an agent's BlockRandom.random_state) for reproducible sampling.
+        """
+        idx = random_state.randint(0, self.size, batch_size)
+        return self.states[idx], self.actions[idx], self.rewards[idx], self.next_states[idx]
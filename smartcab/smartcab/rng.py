@@ -0,0 +1,78 @@
+import numpy as np
+
+
+class BlockRandom(object):
+    """Uniform random numbers drawn from a NumPy RandomState a block at a time.
+
+    For hot consumers that take one number at a time (dummy waypoints, exploration): one vectorized draw per
+    block instead of a generator call per number. random() and choice() follow the random.Random interface.
+    """
+
+    def __init__(self, random_state=None, block_size=1024):
+        self.random_state = random_state if random_state is not None else np.random.RandomState()
+        self.block_size = block_size
+        self.block = []  # pre-drawn numbers (as Python floats, which are faster to index and compare)
+        self.index = 0   # next unused number in block
+        self.array = np.zeros(0)  # block as drawn
+        self.state = None  # random_state's state after drawing block, once getstate() has asked for it
+
+    def random(self):
+        """Random float in [0, 1)."""
+        i = self.index
+        if i >= len(self.block):
+            self.draw_block()
+            i = 0
+        self.index = i + 1
+        return self.block[i]
+
+    def sample(self, n):
+        """Array of the next n random floats in [0, 1): the numbers n calls of random() would return."""
+        numbers = np.empty(n)
+        filled = 0
+        while filled < n:
+            if self.index >= len(self.block):
+                self.draw_block()
+            count = min(n - filled, len(self.block) - self.index)
+            numbers[filled:filled + count] = self.array[self.index:self.index + count]
+            self.index += count
+            filled += count
+        return numbers
+
+    def draw_block(self):
+        self.array = self.random_state.random_sample(self.block_size)
+        self.block = self.array.tolist()
+        self.state = None
+        self.index = 0
+
+    def choice(self, seq):
+        return seq[int(self.random() * len(seq))]
+
+    def getstate(self):
+        """(state of random_state, block array, index), for setstate().
+
+        random_state's state is read once per block, so random_state must only be drawn from through
+        this BlockRandom meanwhile.
+        """
+        if self.state is None:
+            self.state = self.random_state.get_state()
+        return self.state, self.array, self.index
+
+    def setstate(self, state):
+        random_state, array, index = state
+        if self.state is None or not same_state(self.state, random_state):
+            # (otherwise still in the same block: only the index moves, saving the costly set_state())
+            self.random_state.set_state(random_state)
+            self.state = (random_state[0], np.array(random_state[1]), int(random_state[2]), int(random_state[3]), float(random_state[4]))
+            self.array = np.array(array, dtype=np.float64)
+            self.block = self.array.tolist()
+        self.index = index
+
+
+def same_state(a, b):
+    """Whether two RandomState.get_state() tuples are equal."""
+    return a[2] == b[2] and a[3] == b[3] and a[4] == b[4] and np.array_equal(a[1], b[1])
+
+
+def random_locations(random_state, grid_size, shape):
+    """Random intersections (x, y), in Environment coordinates, in an array of the given shape + (2,)."""
+    return np.stack([random_state.randint(1, grid_size[0] + 1, shape), random_state.randint(1, grid_size[1] + 1, shape)], axis=-1)
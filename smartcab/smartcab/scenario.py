@@ -0,0 +1,150 @@
+import argparse
+
+import numpy as np
+
+from .environment import Environment, TrafficLight
+from .rng import random_locations
+
+
+def scenario_dtype(grid_size, num_dummies, num_primary=1):
+    """Record type of one scenario: everything Environment.reset() draws at random, in Environment coordinates.
+
+    Each scenario starts with the (cols, rows) grid size it was drawn for. Headings are indices into
+    Environment.valid_headings and waypoints (the dummies' first moves) indices into Environment.valid_actions;
+    lights holds the light states (True = NS open) of the grid in (x, y) order, packed 8 per byte, and periods
+    their periods.
+    """
+    cols, rows = grid_size
+    return np.dtype([
+        ('grid_size', np.int16, (2,)),
+        ('start', np.int16, (num_primary, 2)),
+        ('destination', np.int16, (num_primary, 2)),
+        ('heading', np.int8, (num_primary,)),
+        ('dummy_location', np.int16, (num_dummies, 2)),
+        ('dummy_heading', np.int8, (num_dummies,)),
+        ('dummy_waypoint', np.int8, (num_dummies,)),
+        ('lights', np.uint8, ((cols * rows + 7) // 8,)),
+        ('periods', np.uint8, (cols, rows))])
+
+
+def generate_array(num_scenarios, grid_size=(8, 6), num_dummies=3, num_primary=1, random_state=None, light_periods=None):
+    """Array of num_scenarios random scenarios, drawn in bulk (start and destination at least 4 apart, as in reset())."""
+    random_state = random_state if random_state is not None else np.random.RandomState()
+    light_periods = light_periods if light_periods is not None else TrafficLight.valid_periods
+    cols, rows = grid_size
+    scenarios = np.zeros(num_scenarios, dtype=scenario_dtype(grid_size, num_dummies, num_primary))
+    scenarios['grid_size'] = grid_size
+
+    start = random_locations(random_state, grid_size, (num_scenarios, num_primary))
+    destination = random_locations(random_state, grid_size, (num_scenarios, num_primary))
+    close = np.abs(destination - start).sum(axis=2) < 4
+    while close.any():
+        start[close] = random_locations(random_state, grid_size, close.sum())
+        destination[close] = random_locations(random_state, grid_size, close.sum())
+        close = np.abs(destination - start).sum(axis=2) < 4
+    scenarios['start'] = start
+    scenarios['destination'] = destination
+    scenarios['heading'] = random_state.randint(0, 4, (num_scenarios, num_primary))
+    scenarios['dummy_location'] = random_locations(random_state, grid_size, (num_scenarios, num_dummies))
+    scenarios['dummy_heading'] = random_state.randint(0, 4, (num_scenarios, num_dummies))
+    scenarios['lights'] = np.packbits(random_state.randint(0, 2, (num_scenarios, cols * rows)).astype(np.uint8), axis=1)
+    scenarios['dummy_waypoint'] = random_state.randint(1, len(Environment.valid_actions), (num_scenarios, num_dummies))  # not None
+    scenarios['periods'] = random_state.choice(light_periods, (num_scenarios, cols, rows))
+    return scenarios
+
+
+def generate(path, num_scenarios, grid_size=(8, 6), num_dummies=3, num_primary=1, seed=None, light_periods=None, chunk_size=65536):
+    """Generate scenarios into a .npy file, chunk by chunk (so files larger than memory can be written)."""
+    random_state = np.random.RandomState(seed)
+    scenarios = np.lib.format.open_memmap(path, mode='w+', dtype=scenario_dtype(grid_size, num_dummies, num_primary), shape=(num_scenarios,))
+    for start in range(0, num_scenarios, chunk_size):
+        end = min(start + chunk_size, num_scenarios)
+        scenarios[start:end] = generate_array(end - start, grid_size, num_dummies, num_primary, random_state, light_periods)
+    scenarios.flush()
+    del scenarios
+
+
+def check(scenarios, grid_size, chunk_size=65536):
+    """Raise ValueError unless all scenarios (an array of scenario_dtype records) were drawn for grid_size and keep
+    starts, destinations and dummy locations on that grid, with light periods of at least 1."""
+    cols, rows = grid_size
+    missing = [name for name in scenario_dtype(grid_size, 0).names if name not in (scenarios.dtype.names or ())]
+    if missing:
+        raise ValueError("scenarios have no {} (generated by an older version?); generate them again".format(", ".join(missing)))
+    for start in range(0, len(scenarios), chunk_size):
+        chunk = scenarios[start:start + chunk_size]
+        wrong_size = np.flatnonzero((chunk['grid_size'] != (cols, rows)).any(axis=1))
+        if len(wrong_size) > 0:
+            i = wrong_size[0]
+            raise ValueError("scenario {} is for a {}x{} grid, not {}x{}".format(start + i, chunk['grid_size'][i][0], chunk['grid_size'][i][1], cols, rows))
+        for field in ('start', 'destination', 'dummy_location'):
+            locations = chunk[field]
+            off_grid = ((locations < 1).any(axis=2) | (locations[:, :, 0] > cols) | (locations[:, :, 1] > rows)).any(axis=1)
+            if off_grid.any():
+                i = np.flatnonzero(off_grid)[0]
+                raise ValueError("scenario {} has a {} off the {}x{} grid: {}".format(start + i, field, cols, rows, chunk[field][i].tolist()))
+        no_period = np.flatnonzero((chunk['periods'] < 1).any(axis=(1, 2)))
+        if len(no_period) > 0:
+            raise ValueError("scenario {} has a light period of 0".format(start + no_period[0]))
+
+
+class ScenarioFile(object):
+    """Iterator over the scenarios in a file written by generate(), memory-mapped rather than loaded.
+
+    Pass to Environment.use_scenarios(); with loop=True it starts over after the last scenario.
+    """
+
+    def __init__(self, path, loop=False):
+        self.scenarios = np.load(path, mmap_mode='r')
+        self.path = path
+        self.loop = loop
+        self.position = 0
+
+    def __len__(self):
+        return len(self.scenarios)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position >= len(self.scenarios):
+            if not self.loop or len(self.scenarios) == 0:
+                raise StopIteration
+            self.position = 0
+        scenario = self.scenarios[self.position]
+        self.position += 1
+        return scenario
+
+    def read(self, count):
+        """Array of the next (up to) count scenarios, read into memory (Environment.reset() reads them this way, a
+        chunk at a time); empty after the last scenario unless loop."""
+        if self.position >= len(self.scenarios) and self.loop:
+            self.position = 0
+        scenarios = np.array(self.scenarios[self.position:self.position + count])
+        self.position += len(scenarios)
+        return scenarios
+
+    def check(self, grid_size):
+        """Raise ValueError unless all scenarios in the file fit grid_size (see check())."""
+        try:
+            check(self.scenarios, grid_size)
+        except ValueError as error:
+            raise ValueError("{}: {}".format(self.path, error))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a file of random scenarios (trial setups) that Environment.reset() can replay.")
+    parser.add_argument('output', help="output file (.npy)")
+    parser.add_argument('--count', type=int, default=10000, help="no. of scenarios (default: 10000)")
+    parser.add_argument('--grid', type=int, nargs=2, default=[8, 6], metavar=('COLS', 'ROWS'), help="grid size (default: 8 6)")
+    parser.add_argument('--dummies', type=int, default=3, help="dummy agents (default: 3)")
+    parser.add_argument('--primary', type=int, default=1, help="primary agents, each with a trip (default: 1)")
+    parser.add_argument('--light-periods', type=int, nargs='+', default=TrafficLight.valid_periods, metavar='PERIOD',
+                        help="light periods to draw from (default: {})".format(" ".join(map(str, TrafficLight.valid_periods))))
+    parser.add_argument('--seed', type=int, default=None, help="random seed")
+    args = parser.parse_args()
+    generate(args.output, args.count, tuple(args.grid), args.dummies, args.primary, args.seed, args.light_periods)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,11 @@ import time
 import random
 import importlib
 
+import numpy as np
+
+from .telemetry import INFO, TRIAL
+from .profiler import profiler
+
 class Simulator(object):
     """Simulates agents in a dynamic smartcab environment.
 
@@ -27,7 +32,7 @@ class Simulator(object):
         'orange'  : (255, 128,   0)
     }
 
-    def __init__(self, env, size=None, update_delay=1.0, display=True):
+    def __init__(self, env, size=None, update_delay=1.0, display=True, fast_forward=False, profile=False, render_fps=None, render_every=None):
         self.env = env
         self.size = size if size is not None else ((self.env.grid_size[0] + 1) * self.env.block_size, (self.env.grid_size[1] + 1) * self.env.block_size)
         self.width, self.height = self.size
@@ -42,7 +47,19 @@ class Simulator(object):
         self.last_updated = 0.0
         self.update_delay = update_delay
 
-        self.display = display
+        self.fast_forward = fast_forward  # step as fast as possible, ignoring update_delay (headless only)
+        self.stats = None  # throughput of the last fast-forward run
+        if profile:
+            profiler.enable()  # per-phase timings, reported at the end of run() (see profiler.py)
+
+        # Sampled display: step as fast as possible and only poll events and render at render_fps frames/sec
+        # and/or every render_every steps (update_delay is then ignored)
+        self.render_fps = render_fps
+        self.render_every = render_every
+        self.last_frame_time = 0.0
+        self.steps_since_frame = 0
+
+        self.display = display and not fast_forward
         if self.display:
             try:
                 self.pygame = importlib.import_module('pygame')
@@ -52,23 +69,41 @@ class Simulator(object):
                 self.frame_delay = max(1, int(self.update_delay * 1000))  # delay between GUI frames in ms (min: 1)
                 self.agent_sprite_size = (32, 32)
                 self.agent_circle_radius = 10  # radius of circle, when using simple representation
+                self.sprites = {}  # color -> {heading: sprite}, rotated once when loaded
                 for agent in self.env.agent_states:
-                    agent._sprite = self.pygame.transform.smoothscale(self.pygame.image.load(os.path.join("images", "car-{}.png".format(agent.color))), self.agent_sprite_size)
-                    agent._sprite_size = (agent._sprite.get_width(), agent._sprite.get_height())
+                    if agent.color not in self.sprites:
+                        sprite = self.pygame.transform.smoothscale(self.pygame.image.load(os.path.join("images", "car-{}.png".format(agent.color))), self.agent_sprite_size)
+                        self.sprites[agent.color] = {heading: self.rotate_sprite(sprite, heading) for heading in self.env.valid_headings}
+                    agent._sprites = self.sprites[agent.color]
+                    agent._sprite_size = self.agent_sprite_size
+                if self.env.traffic is not None:
+                    for color in self.env.traffic.color_choices:
+                        if color not in self.sprites:
+                            sprite = self.pygame.transform.smoothscale(self.pygame.image.load(os.path.join("images", "car-{}.png".format(color))), self.agent_sprite_size)
+                            self.sprites[color] = {heading: self.rotate_sprite(sprite, heading) for heading in self.env.valid_headings}
 
                 self.font = self.pygame.font.Font(None, 28)
+                self.text_cache = {}  # (text, color) -> rendered text surface
+                self.background = self.render_background()  # static layer: roads and intersections
+                self.light_states = None  # light states as last drawn (None: redraw the whole screen)
+                self.dirty_rects = []  # screen areas drawn over the background in the last frame
                 self.paused = False
             except ImportError as e:
                 self.display = False
-                print "Simulator.__init__(): Unable to import pygame; display disabled.\n{}: {}".format(e.__class__.__name__, e)
+                self.env.telemetry.log(INFO, "Simulator.__init__(): Unable to import pygame; display disabled.\n{}: {}", e.__class__.__name__, e)
             except Exception as e:
                 self.display = False
-                print "Simulator.__init__(): Error initializing GUI objects; display disabled.\n{}: {}".format(e.__class__.__name__, e)
+                self.env.telemetry.log(INFO, "Simulator.__init__(): Error initializing GUI objects; display disabled.\n{}: {}", e.__class__.__name__, e)
+
+    def run(self, n_trials=1, on_trial_end=None):
+        # on_trial_end(env) is called after each completed trial; if it returns True, no more trials are run
+        if self.fast_forward:
+            return self.run_fast_forward(n_trials, on_trial_end)
 
-    def run(self, n_trials=1):
         self.quit = False
-        for trial in xrange(n_trials):
-            print "Simulator.run(): Trial {}".format(trial)  # [debug]
+        sampled = self.render_fps is not None or self.render_every is not None
+        for trial in range(n_trials):
+            self.env.telemetry.log(TRIAL, "Simulator.run(): Trial {}", trial)  # [debug]
             self.env.reset()
             self.current_time = 0.0
             self.last_updated = 0.0
@@ -77,39 +112,28 @@ class Simulator(object):
                 try:
                     # Update current time
                     self.current_time = time.time() - self.start_time
-                    #print "Simulator.run(): current_time = {:.3f}".format(self.current_time)
-
-                    # Handle GUI events
-                    if self.display:
-                        for event in self.pygame.event.get():
-                            if event.type == self.pygame.QUIT:
-                                self.quit = True
-                            elif event.type == self.pygame.KEYDOWN:
-                                if event.key == 27:  # Esc
-                                    self.quit = True
-                                elif event.unicode == u' ':
-                                    self.paused = True
-                                elif event.unicode == u'u' or event.unicode == u'U':
-                                    self.debug_u = not self.debug_u
-                                elif event.unicode == u's' or event.unicode == u'S':
-                                    self.debug_s = not self.debug_s
-                                elif event.unicode == u'p' or event.unicode == u'P':
-                                    self.debug_p = not self.debug_p
-                                elif event.unicode == u'e' or event.unicode == u'E':
-                                    self.debug_e = not self.debug_e
+                    #print("Simulator.run(): current_time = {:.3f}".format(self.current_time))
 
+                    # Handle GUI events (in sampled mode, only when a frame is due)
+                    frame = self.display and (not sampled or self.frame_due())
+                    if frame:
+                        self.handle_events()
                         if self.paused:
                             self.pause()
 
                     # Update environment
-                    if self.current_time - self.last_updated >= self.update_delay:
+                    if sampled or self.current_time - self.last_updated >= self.update_delay:
                         self.env.step()
                         self.last_updated = self.current_time
+                        self.steps_since_frame += 1
 
-                    # Render GUI and sleep
-                    if self.display:
+                    # Render GUI and sleep (in sampled mode, don't sleep)
+                    if frame:
                         self.render()
-                        self.pygame.time.wait(self.frame_delay)
+                        self.last_frame_time = time.time()
+                        self.steps_since_frame = 0
+                        if not sampled:
+                            self.pygame.time.wait(self.frame_delay)
                 except KeyboardInterrupt:
                     self.quit = True
                 finally:
@@ -118,68 +142,188 @@ class Simulator(object):
 
             if self.quit:
                 break
+            if on_trial_end is not None and on_trial_end(self.env):
+                self.env.telemetry.log(INFO, "Simulator.run(): stopping after {} trials", trial + 1)
+                break
 
-    def render(self):
-        # Clear screen
-        self.screen.fill(self.bg_color)
+        self.env.telemetry.flush()
+        self.report_profile()
+
+    def run_fast_forward(self, n_trials=1, on_trial_end=None):
+        """Run trials headless, stepping the environment as fast as the CPU allows."""
+        self.quit = False
+        env = self.env
+        n_steps = 0
+        trials_run = 0
+        start_time = time.time()
+        try:
+            for trial in range(n_trials):
+                env.telemetry.log(TRIAL, "Simulator.run(): Trial {}", trial)  # [debug]
+                env.reset()
+                while not env.done:
+                    env.step()
+                    n_steps += 1
+                trials_run += 1
+                if on_trial_end is not None and on_trial_end(env):
+                    env.telemetry.log(INFO, "Simulator.run(): stopping after {} trials", trials_run)
+                    break
+        except KeyboardInterrupt:
+            self.quit = True
+
+        elapsed = max(time.time() - start_time, 1e-9)
+        self.stats = {
+            'trials': trials_run,
+            'steps': n_steps,
+            'elapsed': elapsed,
+            'steps_per_sec': n_steps / elapsed,
+            'trials_per_sec': trials_run / elapsed}
+        env.telemetry.flush()
+        env.telemetry.log(INFO, "Simulator.run(): {trials} trials, {steps} steps in {elapsed:.3f}s ({steps_per_sec:.1f} steps/sec, {trials_per_sec:.1f} trials/sec)".format(**self.stats))
+        self.report_profile()
+        return self.stats
 
-        # Draw elements
-        # * Static elements
+    def frame_due(self):
+        if self.render_every is not None and self.steps_since_frame >= self.render_every:
+            return True
+        return self.render_fps is not None and time.time() - self.last_frame_time >= 1.0 / self.render_fps
+
+    def handle_events(self):
+        for event in self.pygame.event.get():
+            if event.type == self.pygame.QUIT:
+                self.quit = True
+            elif event.type == self.pygame.KEYDOWN:
+                if event.key == 27:  # Esc
+                    self.quit = True
+                elif event.unicode == ' ':
+                    self.paused = True
+                elif event.unicode == 'u' or event.unicode == 'U':
+                    self.debug_u = not self.debug_u
+                elif event.unicode == 's' or event.unicode == 'S':
+                    self.debug_s = not self.debug_s
+                elif event.unicode == 'p' or event.unicode == 'P':
+                    self.debug_p = not self.debug_p
+                elif event.unicode == 'e' or event.unicode == 'E':
+                    self.debug_e = not self.debug_e
+
+    def report_profile(self):
+        if profiler.enabled:
+            self.env.telemetry.log(INFO, "Simulator.run(): per-phase profile\n{}", profiler.report())
+
+    def rotate_sprite(self, sprite, heading):
+        return sprite if heading == (1, 0) else self.pygame.transform.rotate(sprite, 180 if heading[0] == -1 else heading[1] * -90)
+
+    def render_text(self, text, color):
+        key = (text, color)
+        surface = self.text_cache.get(key)
+        if surface is None:
+            if len(self.text_cache) >= 1024:
+                self.text_cache.clear()  # status text changes every step, so don't let the cache grow without bound
+            surface = self.text_cache[key] = self.font.render(text, True, color, self.bg_color)
+        return surface
+
+    def render_background(self):
+        # Static elements (roads and intersections) are drawn once onto a background surface
+        background = self.pygame.Surface(self.size)
+        background.fill(self.bg_color)
         for road in self.env.roads:
-            self.pygame.draw.line(self.screen, self.road_color, (road[0][0] * self.env.block_size, road[0][1] * self.env.block_size), (road[1][0] * self.env.block_size, road[1][1] * self.env.block_size), self.road_width)
-
-        for intersection, traffic_light in self.env.intersections.iteritems():
-            self.pygame.draw.circle(self.screen, self.road_color, (intersection[0] * self.env.block_size, intersection[1] * self.env.block_size), 10)
-            if traffic_light.state:  # North-South is open
-                self.pygame.draw.line(self.screen, self.colors['green'],
-                    (intersection[0] * self.env.block_size, intersection[1] * self.env.block_size - 15),
-                    (intersection[0] * self.env.block_size, intersection[1] * self.env.block_size + 15), self.road_width)
-            else:  # East-West is open
-                self.pygame.draw.line(self.screen, self.colors['green'],
-                    (intersection[0] * self.env.block_size - 15, intersection[1] * self.env.block_size),
-                    (intersection[0] * self.env.block_size + 15, intersection[1] * self.env.block_size), self.road_width)
+            self.pygame.draw.line(background, self.road_color, (road[0][0] * self.env.block_size, road[0][1] * self.env.block_size), (road[1][0] * self.env.block_size, road[1][1] * self.env.block_size), self.road_width)
+        for intersection in self.env.intersections:
+            self.pygame.draw.circle(background, self.road_color, (intersection[0] * self.env.block_size, intersection[1] * self.env.block_size), 10)
+        return background
+
+    def render_light(self, intersection, state):
+        # Restore the intersection from the background, then draw the open direction; returns the area drawn
+        x, y = intersection[0] * self.env.block_size, intersection[1] * self.env.block_size
+        area = self.pygame.Rect(x - 15 - self.road_width, y - 15 - self.road_width, 30 + 2 * self.road_width, 30 + 2 * self.road_width)
+        self.screen.blit(self.background, area, area)
+        if state:  # North-South is open
+            self.pygame.draw.line(self.screen, self.colors['green'], (x, y - 15), (x, y + 15), self.road_width)
+        else:  # East-West is open
+            self.pygame.draw.line(self.screen, self.colors['green'], (x - 15, y), (x + 15, y), self.road_width)
+        return area
+
+    def render(self):
+        # Only areas that change are redrawn: whatever was drawn over the background in the last frame is erased,
+        # lights that changed (or were partly erased) are redrawn, then all agents and overlays are drawn again
+        lights = self.env.intersections
+        states = lights.states
+        x0, y0 = lights.bounds[0], lights.bounds[1]
+        updated = []
+        if self.light_states is None or sum(rect.width * rect.height for rect in self.dirty_rects) > self.width * self.height / 2:
+            # Full redraw (also cheaper than erasing many small areas when most of the screen is covered)
+            self.screen.blit(self.background, (0, 0))
+            redraw = np.ones(states.shape, dtype=bool)
+            updated.append(self.screen.get_rect())
+        else:
+            for rect in self.dirty_rects:
+                self.screen.blit(self.background, rect, rect)
+            redraw = states != self.light_states
+            margin = 15 + self.road_width
+            block_size = self.env.block_size
+            for rect in self.dirty_rects:
+                # lights whose area overlaps an erased rect
+                i0 = max(-((margin - rect.left) // block_size) - x0, 0)
+                i1 = min((rect.right + margin) // block_size - x0, states.shape[0] - 1)
+                j0 = max(-((margin - rect.top) // block_size) - y0, 0)
+                j1 = min((rect.bottom + margin) // block_size - y0, states.shape[1] - 1)
+                if i0 <= i1 and j0 <= j1:
+                    redraw[i0:i1 + 1, j0:j1 + 1] = True
+            updated.extend(self.dirty_rects)
+        for i, j in zip(*np.nonzero(redraw)):
+            updated.append(self.render_light((i + x0, j + y0), states[i, j]))
+        self.light_states = states
 
         # * Dynamic elements
-        for agent, state in self.env.agent_states.iteritems():
+        dirty = []
+        if self.env.traffic is not None:
+            # Traffic field cars (drawn first, as they come before all agents)
+            sprite_w, sprite_h = self.agent_sprite_size
+            for location, heading, waypoint, color in self.env.traffic.cars():
+                car_pos = (location[0] * self.env.block_size - 2 * heading[0] * self.agent_circle_radius, location[1] * self.env.block_size - 2 * heading[1] * self.agent_circle_radius)
+                area = self.screen.blit(self.sprites[color][heading], self.pygame.rect.Rect(car_pos[0] - sprite_w // 2, car_pos[1] - sprite_h // 2, sprite_w, sprite_h))
+                area.union_ip(self.screen.blit(self.render_text(waypoint, self.colors[color]), (car_pos[0] + 10, car_pos[1] + 10)))
+                dirty.append(area)
+        for agent, state in self.env.agent_states.items():
             # Compute precise agent location here (back from the intersection some)
-            agent_offset = (2 * state['heading'][0] * self.agent_circle_radius, 2 * state['heading'][1] * self.agent_circle_radius)
-            agent_pos = (state['location'][0] * self.env.block_size - agent_offset[0], state['location'][1] * self.env.block_size - agent_offset[1])
+            agent_offset = (2 * state.heading[0] * self.agent_circle_radius, 2 * state.heading[1] * self.agent_circle_radius)
+            agent_pos = (state.location[0] * self.env.block_size - agent_offset[0], state.location[1] * self.env.block_size - agent_offset[1])
             agent_color = self.colors[agent.color]
-            if hasattr(agent, '_sprite') and agent._sprite is not None:
-                # Draw agent sprite (image), properly rotated
-                rotated_sprite = agent._sprite if state['heading'] == (1, 0) else self.pygame.transform.rotate(agent._sprite, 180 if state['heading'][0] == -1 else state['heading'][1] * -90)
-                self.screen.blit(rotated_sprite,
-                    self.pygame.rect.Rect(agent_pos[0] - agent._sprite_size[0] / 2, agent_pos[1] - agent._sprite_size[1] / 2,
+            if getattr(agent, '_sprites', None) is not None:
+                # Draw agent sprite (image), rotated when loaded
+                area = self.screen.blit(agent._sprites[state.heading],
+                    self.pygame.rect.Rect(agent_pos[0] - agent._sprite_size[0] // 2, agent_pos[1] - agent._sprite_size[1] // 2,
                         agent._sprite_size[0], agent._sprite_size[1]))
             else:
                 # Draw simple agent (circle with a short line segment poking out to indicate heading)
-                self.pygame.draw.circle(self.screen, agent_color, agent_pos, self.agent_circle_radius)
-                self.pygame.draw.line(self.screen, agent_color, agent_pos, state['location'], self.road_width)
+                area = self.pygame.draw.circle(self.screen, agent_color, agent_pos, self.agent_circle_radius)
+                area.union_ip(self.pygame.draw.line(self.screen, agent_color, agent_pos, state.location, self.road_width))
             if agent.get_next_waypoint() is not None:
-                self.screen.blit(self.font.render(agent.get_next_waypoint(), True, agent_color, self.bg_color), (agent_pos[0] + 10, agent_pos[1] + 10))
-            if state['destination'] is not None:
-                self.pygame.draw.circle(self.screen, agent_color, (state['destination'][0] * self.env.block_size, state['destination'][1] * self.env.block_size), 6)
-                self.pygame.draw.circle(self.screen, agent_color, (state['destination'][0] * self.env.block_size, state['destination'][1] * self.env.block_size), 15, 2)
+                area.union_ip(self.screen.blit(self.render_text(agent.get_next_waypoint(), agent_color), (agent_pos[0] + 10, agent_pos[1] + 10)))
+            dirty.append(area)
+            if state.destination is not None:
+                dirty.append(self.pygame.draw.circle(self.screen, agent_color, (state.destination[0] * self.env.block_size, state.destination[1] * self.env.block_size), 6))
+                dirty.append(self.pygame.draw.circle(self.screen, agent_color, (state.destination[0] * self.env.block_size, state.destination[1] * self.env.block_size), 15, 2))
 
         # * Overlays
         text_y = 10
         for text in self.env.status_text.split('\n'):
-            self.screen.blit(self.font.render(text, True, self.colors['red'], self.bg_color), (100, text_y))
+            dirty.append(self.screen.blit(self.render_text(text, self.colors['red']), (100, text_y)))
             text_y += 20
 
-        # Flip buffers
-        self.pygame.display.flip()
+        # Update changed areas of the display
+        self.dirty_rects = dirty
+        self.pygame.display.update(updated + dirty)
 
     def pause(self):
         abs_pause_time = time.time()
         pause_text = "[PAUSED] Press any key to continue..."
-        self.screen.blit(self.font.render(pause_text, True, self.colors['cyan'], self.bg_color), (100, self.height - 40))
-        self.pygame.display.flip()
-        print pause_text  # [debug]
+        pause_rect = self.screen.blit(self.render_text(pause_text, self.colors['cyan']), (100, self.height - 40))
+        self.pygame.display.update(pause_rect)
+        print(pause_text)  # [debug]
         while self.paused:
             for event in self.pygame.event.get():
                 if event.type == self.pygame.KEYDOWN:
                     self.paused = False
             self.pygame.time.wait(self.frame_delay)
-        self.screen.blit(self.font.render(pause_text, True, self.bg_color, self.bg_color), (100, self.height - 40))
+        self.dirty_rects.append(pause_rect)  # erased with the next frame
         self.start_time += (time.time() - abs_pause_time)
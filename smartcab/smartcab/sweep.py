@@ -0,0 +1,120 @@
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from .environment import Environment
+from .simulator import Simulator
+from .agent import LearningAgent
+from .telemetry import QUIET
+from .convergence import ConvergenceMonitor
+
+# LearningAgent class attributes that can be swept, with the type used to parse them from the command line
+tunable_params = [
+    ('learning_rate', float),
+    ('discount_rate', float),
+    ('max_exploration_rate', float),
+    ('min_exploration_rate', float),
+    ('decay_exploration_rate', float),
+    ('num_of_trials', int),
+    ('learn_from_next_state', int),
+    ('replay_capacity', int),
+    ('replay_ratio', float),
+    ('replay_batch_size', int)]
+
+
+def expand_grid(grid):
+    """List of parameter dicts, one per combination in a {name: [values]} grid."""
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def run_config(job):
+    """Train a LearningAgent headless with one set of parameters and seed (stopping early once converged, if
+    early_stop); return its metrics."""
+    params, seed, early_stop = job
+    e = Environment(seed=seed)
+    e.telemetry.level = QUIET  # no per-trial console output from workers
+    a = e.create_agent(LearningAgent, **params)
+    e.set_primary_agent(a, enforce_deadline=True)
+    sim = Simulator(e, display=False, fast_forward=True)
+    a.sim = sim
+    stats = sim.run(n_trials=a.num_of_trials, on_trial_end=ConvergenceMonitor(a.q_table) if early_stop else None)
+
+    return {
+        'params': params,
+        'seed': seed,
+        'trials': stats['trials'],
+        'success_rate': a.destination_reached_count * 1.0 / max(stats['trials'], 1),
+        'penalties': a.penalty_count,
+        'mean_steps_to_goal': np.mean(a.steps_to_goal) if a.steps_to_goal else float('nan'),
+        'elapsed': stats['elapsed']}
+
+
+def aggregate(results):
+    """Average per-seed results into one row per parameter set, best success rate first."""
+    rows = []
+    key = lambda result: sorted(result['params'].items())
+    for params, group in itertools.groupby(sorted(results, key=key), key=key):
+        group = list(group)
+        row = dict(params)
+        row['seeds'] = len(group)
+        row['trials'] = np.mean([result['trials'] for result in group])
+        row['success_rate'] = np.mean([result['success_rate'] for result in group])
+        row['penalties'] = np.mean([result['penalties'] for result in group])
+        steps = [result['mean_steps_to_goal'] for result in group if not np.isnan(result['mean_steps_to_goal'])]
+        row['mean_steps_to_goal'] = np.mean(steps) if steps else float('nan')
+        rows.append(row)
+    rows.sort(key=lambda row: (-row['success_rate'], row['penalties']))
+    return rows
+
+
+def format_table(rows, columns):
+    """Plain-text table of rows (dicts) with the given columns."""
+    cells = [columns] + [["{:.4g}".format(row[c]) if isinstance(row[c], float) else str(row[c]) for c in columns] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(line, widths)) for line in cells)
+
+
+def sweep(grid, seeds=1, base_seed=0, processes=None, early_stop=False):
+    """Run every parameter combination in grid for each of seeds seeds across a process pool.
+
+    Returns one aggregated row (dict) per parameter combination.
+    """
+    jobs = [(params, base_seed + i, early_stop) for params in expand_grid(grid) for i in range(seeds)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(run_config, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return aggregate(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Grid search over LearningAgent parameters using headless runs in a process pool.")
+    for name, value_type in tunable_params:
+        parser.add_argument('--' + name, type=value_type, nargs='+', default=[getattr(LearningAgent, name)], metavar='VALUE',
+                            help="values to try (default: {})".format(getattr(LearningAgent, name)))
+    parser.add_argument('--seeds', type=int, default=1, help="independent runs per parameter set, each with its own seed (default: 1)")
+    parser.add_argument('--base-seed', type=int, default=0, help="seed of the first run; run i uses base-seed + i (default: 0)")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes (default: no. of CPUs)")
+    parser.add_argument('--csv', default=None, help="also write the results table to this CSV file")
+    parser.add_argument('--early-stop', action='store_true', help="stop each run once training has converged (see ConvergenceMonitor)")
+    args = parser.parse_args()
+
+    grid = {name: getattr(args, name) for name, value_type in tunable_params}
+    rows = sweep(grid, seeds=args.seeds, base_seed=args.base_seed, processes=args.processes, early_stop=args.early_stop)
+
+    columns = [name for name, value_type in tunable_params] + ['seeds', 'trials', 'success_rate', 'penalties', 'mean_steps_to_goal']
+    print(format_table(rows, columns))
+    if args.csv is not None:
+        with open(args.csv, 'w') as f:
+            f.write(",".join(columns) + "\n")
+            for row in rows:
+                f.write(",".join(str(row[c]) for c in columns) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+
+# Log levels, from quietest to most verbose
+QUIET = 0  # no console output
+INFO = 1   # run summaries and warnings
+TRIAL = 2  # one or two lines per trial (setup, goal reached, aborted)
+DEBUG = 3  # everything, including route planner messages
+
+# Columns of per-step records (primary agents) and per-trial records
+step_columns = [
+    ('agent', np.int16),     # index in Environment.primary_agents
+    ('trial', np.int32),
+    ('t', np.int32),
+    ('state', np.int16),     # state index (see StateEncoder), -1 if unknown
+    ('action', np.int8),     # index into Environment.valid_actions
+    ('reward', np.float32),
+    ('deadline', np.int32),  # deadline before acting
+    ('success', np.bool_)]   # destination reached by this step
+trial_columns = [
+    ('agent', np.int16),     # index in Environment.primary_agents
+    ('trial', np.int32),
+    ('steps', np.int32),
+    ('deadline', np.int32),  # deadline left at the end of the trial
+    ('success', np.bool_),
+    ('reward', np.float32),  # net reward
+    ('penalties', np.int32)]
+
+
+class ColumnBuffer(object):
+    """Preallocated column arrays for one kind of record, flushed in bulk to one raw binary file per column."""
+
+    def __init__(self, columns, capacity, path=None):
+        self.columns = columns
+        self.names = [name for name, dtype in columns]
+        self.capacity = capacity
+        self.path = path  # files are <path>.<column>; nothing is written if None
+        self.data = {name: np.zeros(capacity, dtype=dtype) for name, dtype in columns}
+        self.size = 0
+
+    def append(self, *values):
+        i = self.size
+        data = self.data
+        for name, value in zip(self.names, values):
+            data[name][i] = value
+        self.size = i + 1
+        if self.size == self.capacity:
+            self.flush()
+
+    def flush(self):
+        if self.path is not None and self.size > 0:
+            for name in self.names:
+                with open("{}.{}".format(self.path, name), 'ab') as f:
+                    self.data[name][:self.size].tofile(f)
+        self.size = 0
+
+
+class TelemetryRecorder(object):
+    """Collects per-step and per-trial records into column buffers, and gates console output by log level.
+
+    With a path, records are appended in bulk to raw column files under that directory (see load());
+    without one, nothing is recorded and the recorder only filters log messages.
+    """
+
+    def __init__(self, path=None, level=DEBUG, capacity=65536):
+        self.path = path
+        self.level = level
+        self.recording = path is not None
+        if self.recording and not os.path.isdir(path):
+            os.makedirs(path)
+        self.steps = ColumnBuffer(step_columns, capacity if self.recording else 1, os.path.join(path, 'steps') if self.recording else None)
+        self.trials = ColumnBuffer(trial_columns, capacity if self.recording else 1, os.path.join(path, 'trials') if self.recording else None)
+
+    def log(self, level, message, *args):
+        """Print message (formatted with args) if level is enabled; formatting is skipped otherwise."""
+        if level <= self.level:
+            print(message.format(*args) if args else message)
+
+    def record_step(self, agent, trial, t, state, action, reward, deadline, success):
+        if self.recording:
+            self.steps.append(agent, trial, t, state, action, reward, deadline, success)
+
+    def record_trial(self, agent, trial, steps, deadline, success, reward, penalties):
+        if self.recording:
+            self.trials.append(agent, trial, steps, deadline, success, reward, penalties)
+
+    def flush(self):
+        self.steps.flush()
+        self.trials.flush()
+
+
+def load(path):
+    """Read recorded telemetry back as {'steps': {column: array}, 'trials': {column: array}}."""
+    tables = {}
+    for table, columns in (('steps', step_columns), ('trials', trial_columns)):
+        tables[table] = {}
+        for name, dtype in columns:
+            filename = os.path.join(path, "{}.{}".format(table, name))
+            tables[table][name] = np.fromfile(filename, dtype=dtype) if os.path.exists(filename) else np.zeros(0, dtype=dtype)
+    return tables
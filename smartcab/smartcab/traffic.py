@@ -0,0 +1,161 @@
+import bisect
+
+import numpy as np
+
+from .rng import random_locations
+
+
+def sense_others(heading, others, oncoming=None, left=None, right=None):
+    """(oncoming, left, right) as Environment.sense() finds them for an agent with heading, from (heading, next
+    waypoint) pairs of those at its intersection, in order, going on from the given values (those heading the
+    same way, the agent itself included, do not count)."""
+    hx, hy = heading
+    for (x, y), waypoint in others:
+        if x == hx and y == hy:
+            continue
+        if hx * x + hy * y == -1:
+            if oncoming != 'left':  # we don't want to override oncoming == 'left'
+                oncoming = waypoint
+        elif hy == x and hx == -y:
+            if right != 'forward' and right != 'left':  # we don't want to override right == 'forward or 'left'
+                right = waypoint
+        else:
+            if left != 'forward':  # we don't want to override left == 'forward'
+                left = waypoint
+    return oncoming, left, right
+
+
+class TrafficField(object):
+    """Background traffic: cars that drive like DummyAgents, kept in arrays and moved in one vectorized pass per step."""
+
+    color_choices = ['blue', 'cyan', 'magenta', 'orange']
+
+    def __init__(self, env, num_cars):
+        self.env = env
+        self.random = env.traffic_random  # next waypoints, as for DummyAgents
+        self.forward, self.left, self.right = [env.valid_actions.index(a) for a in ('forward', 'left', 'right')]
+        self.heading_dx = np.array([h[0] for h in env.valid_headings], dtype=np.int32)
+        self.heading_dy = np.array([h[1] for h in env.valid_headings], dtype=np.int32)  # ENWS: a left turn is +1, a right turn -1 (mod 4)
+        self.shape = env.intersections.shape
+        self.x0, self.y0 = env.bounds[0], env.bounds[1]
+
+        self.x = np.zeros(num_cars, dtype=np.int32)  # 0-based: x - bounds[0] in Environment coordinates
+        self.y = np.zeros(num_cars, dtype=np.int32)
+        self.heading = np.zeros(num_cars, dtype=np.int8)  # index into env.valid_headings
+        self.waypoint = (self.forward + self.random.sample(num_cars) * 3).astype(np.int8)  # index into env.valid_actions, redrawn after each move
+        self.color = (self.random.sample(num_cars) * len(self.color_choices)).astype(np.int8)  # index into color_choices
+        self.reset()
+
+    def __len__(self):
+        return len(self.x)
+
+    def reset(self, locations=None, headings=None, waypoints=None):
+        """Place the cars at the given (Environment coordinates) locations and headings, or at random; waypoints (if
+        given) replace their next waypoints."""
+        n = len(self)
+        if locations is None:
+            random_state = np.random.RandomState(self.env.random.getrandbits(32))
+            locations = random_locations(random_state, self.shape, n) - 1
+            headings = random_state.randint(0, 4, n)
+        else:
+            locations = np.asarray(locations, dtype=np.int32).reshape(n, 2) - (self.x0, self.y0)
+        self.x[:] = locations[:, 0]
+        self.y[:] = locations[:, 1]
+        self.heading[:] = headings
+        if waypoints is not None:
+            self.waypoint[:] = waypoints
+        self.index_cells()
+
+    def step(self):
+        """Move all cars one step, by the DummyAgent rules, against the light states and traffic (cars and agents) at the
+        start of the step; unlike DummyAgents, which take turns, the cars all move together."""
+        env = self.env
+        n = len(self)
+        if n == 0:
+            return n
+        cols, rows = self.shape
+
+        # Everyone at an intersection: the cars, then the (unparked) agents, in creation order
+        agents = [(agent, state) for agent, state in env.agent_states.items() if agent not in env.parked]
+        if agents:
+            heading_index = env._heading_index
+            action_index = env._action_index
+            x = np.concatenate([self.x, [state.location[0] - self.x0 for agent, state in agents]]).astype(np.int32)
+            y = np.concatenate([self.y, [state.location[1] - self.y0 for agent, state in agents]]).astype(np.int32)
+            heading = np.concatenate([self.heading, [heading_index[state.heading] for agent, state in agents]]).astype(np.int8)
+            waypoint = np.concatenate([self.waypoint, [action_index[agent.get_next_waypoint()] for agent, state in agents]]).astype(np.int8)
+        else:
+            x, y, heading, waypoint = self.x, self.y, self.heading, self.waypoint
+
+        # Traffic at each (intersection, heading): whether anyone goes forward or left, and the waypoint of the last
+        key = (x.astype(np.int64) * rows + y) * 4 + heading
+        order = np.argsort(key, kind='stable')
+        sorted_key = key[order]
+        starts = np.flatnonzero(np.r_[True, sorted_key[1:] != sorted_key[:-1]])
+        group_key = sorted_key[starts]
+        sorted_waypoint = waypoint[order]
+        any_forward = np.logical_or.reduceat(sorted_waypoint == self.forward, starts)
+        any_left = np.logical_or.reduceat(sorted_waypoint == self.left, starts)
+        last_waypoint = sorted_waypoint[np.r_[starts[1:], len(order)] - 1]
+
+        # What each car senses (see Environment.sense): oncoming traffic comes from heading + 2, traffic from the left from heading - 1
+        cell = (self.x.astype(np.int64) * rows + self.y) * 4
+        own = self.heading.astype(np.int64)
+        oncoming, found_oncoming = self._lookup(group_key, cell + (own + 2) % 4)
+        from_left, found_left = self._lookup(group_key, cell + (own + 3) % 4)
+        blocked_by_oncoming = found_oncoming & ~any_left[oncoming] & ((last_waypoint[oncoming] == self.forward) | (last_waypoint[oncoming] == self.right))
+        left_forward = found_left & any_forward[from_left]
+
+        # Right of way (see DummyAgent.update)
+        light = env.intersections.phases[self.x, self.y] ^ ((env.intersections.t // env.intersections.periods[self.x, self.y]) % 2 == 1)
+        green = np.where(self.heading % 2 == 1, light, ~light)  # N and S are odd
+        wp = self.waypoint
+        move = np.where(wp == self.forward, green,
+                        np.where(wp == self.left, green & ~blocked_by_oncoming, green | ~left_forward))
+
+        # Move, and draw the next waypoint of cars that moved
+        moved = np.flatnonzero(move)
+        turn = np.where(wp[moved] == self.left, 1, np.where(wp[moved] == self.right, 3, 0))
+        new_heading = (self.heading[moved] + turn) % 4
+        self.heading[moved] = new_heading
+        self.x[moved] = (self.x[moved] + self.heading_dx[new_heading]) % cols
+        self.y[moved] = (self.y[moved] + self.heading_dy[new_heading]) % rows
+        self.waypoint[moved] = self.forward + (self.random.sample(len(moved)) * 3).astype(np.int8)
+        self.index_cells()
+        return n
+
+    def _lookup(self, group_key, query):
+        # index into group_key of each query key, and whether it was found
+        index = np.minimum(np.searchsorted(group_key, query), len(group_key) - 1)
+        return index, group_key[index] == query
+
+    def index_cells(self):
+        """Forget the cars' intersections (as last looked up by cars_at()), after they moved."""
+        self.cell_order = None
+        self.sorted_cell = None  # built on the first cars_at() call after the cars moved
+
+    def cars_at(self, location):
+        """Indices of the cars at an intersection (Environment coordinates), in creation order."""
+        if self.sorted_cell is None:
+            cells = self.x.astype(np.int64) * self.shape[1] + self.y
+            self.cell_order = np.argsort(cells, kind='stable')
+            self.sorted_cell = cells[self.cell_order].tolist()
+        cell = (location[0] - self.x0) * self.shape[1] + (location[1] - self.y0)
+        sorted_cell = self.sorted_cell
+        lo = bisect.bisect_left(sorted_cell, cell)
+        if lo == len(sorted_cell) or sorted_cell[lo] != cell:
+            return []
+        return self.cell_order[lo:bisect.bisect_right(sorted_cell, cell, lo)].tolist()
+
+    def sense(self, location, heading):
+        """(oncoming, left, right) as Environment.sense() finds them from the cars at location, for an agent with heading."""
+        valid_headings = self.env.valid_headings
+        valid_actions = self.env.valid_actions
+        return sense_others(heading, [(valid_headings[self.heading[i]], valid_actions[self.waypoint[i]]) for i in self.cars_at(location)])
+
+    def cars(self):
+        """(location, heading, next waypoint, color) of each car, in Environment terms, for display."""
+        valid_headings = self.env.valid_headings
+        valid_actions = self.env.valid_actions
+        for x, y, heading, waypoint, color in zip(self.x.tolist(), self.y.tolist(), self.heading.tolist(), self.waypoint.tolist(), self.color.tolist()):
+            yield (x + self.x0, y + self.y0), valid_headings[heading], valid_actions[waypoint], self.color_choices[color]